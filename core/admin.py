@@ -10,7 +10,8 @@ class EmbeddingInline(admin.StackedInline):
 
 
 class DocumentAdmin(admin.ModelAdmin):
-    list_display = ["id", "file", "status"]
+    list_display = ["id", "file", "status", "passage_count", "embedding_count"]
+    list_filter = ["status"]
     exclude = ["embeddings"]
     inlines = [EmbeddingInline]
 
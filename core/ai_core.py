@@ -1,8 +1,26 @@
+import asyncio
+import hashlib
 import os
+import re
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from functools import cache
+from logging import getLogger
+from typing import Literal
 
+import httpx
+import orjson
+
+from django.conf import settings
+from django.core.cache import caches
 from langchain.chat_models import init_chat_model
+from langchain_core.documents import Document as LangchainDocument
 from langchain_core.embeddings import FakeEmbeddings
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import AnyMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import RunnableLambda
 from langchain_openai import OpenAIEmbeddings
 from langchain_openai.embeddings import AzureOpenAIEmbeddings
@@ -12,28 +30,266 @@ from pydantic import Field, BaseModel
 
 load_dotenv()
 
+logger = getLogger(__name__)
+
 LLM_MODEL = os.environ["LLM_MODEL"]
 LLM_MODEL_PROVIDER = os.environ["LLM_MODEL_PROVIDER"]
 EMBEDDING_MODEL = os.environ["EMBEDDING_MODEL"]
 
 
+class ClientMetrics:
+    """Counts the requests, errors and time spent by a pooled http client"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.seconds = 0.0
+
+    def start(self) -> float:
+        with self._lock:
+            self.in_flight += 1
+        return time.monotonic()
+
+    def finish(self, started_at: float, error: bool):
+        elapsed = time.monotonic() - started_at
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.errors += error
+            self.seconds += elapsed
+
+    def info(self) -> dict[str, int | float]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "seconds": self.seconds,
+        }
+
+
+class MetricsTransport(httpx.BaseTransport):
+    """a transport that counts requests, including those that fail to connect or
+    time out, which never get a response"""
+
+    def __init__(self, metrics: ClientMetrics, transport: httpx.BaseTransport):
+        self.metrics = metrics
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started_at = self.metrics.start()
+        error = True
+        try:
+            response = self.transport.handle_request(request)
+            error = response.is_error
+            return response
+        finally:
+            self.metrics.finish(started_at, error)
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncMetricsTransport(httpx.AsyncBaseTransport):
+    """as MetricsTransport, connections belong to the event loop they were made in
+    so each loop gets its own pool, made by make_transport, which is closed with
+    the client or dropped with the loop"""
+
+    def __init__(self, metrics: ClientMetrics, make_transport):
+        self.metrics = metrics
+        self.make_transport = make_transport
+        self.transports: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, httpx.AsyncBaseTransport
+        ] = weakref.WeakKeyDictionary()
+
+    def get_transport(self) -> httpx.AsyncBaseTransport:
+        loop = asyncio.get_running_loop()
+        if (transport := self.transports.get(loop)) is None:
+            transport = self.transports[loop] = self.make_transport()
+        return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started_at = self.metrics.start()
+        error = True
+        try:
+            response = await self.get_transport().handle_async_request(request)
+            error = response.is_error
+            return response
+        finally:
+            self.metrics.finish(started_at, error)
+
+    async def aclose(self):
+        if (
+            transport := self.transports.pop(asyncio.get_running_loop(), None)
+        ) is not None:
+            await transport.aclose()
+
+
+client_metrics: dict[str, ClientMetrics] = {}
+
+
+@cache
+def get_http_clients(name: str) -> tuple[httpx.Client, httpx.AsyncClient]:
+    """keep-alive connection pools shared by every use of a model in this process,
+    the pool size bounds the number of concurrent requests to the model"""
+    max_connections = settings.HTTP_MAX_CONNECTIONS[name]
+    limits = httpx.Limits(
+        max_connections=max_connections, max_keepalive_connections=max_connections
+    )
+    metrics = client_metrics[name] = ClientMetrics()
+    http_client = httpx.Client(
+        timeout=settings.HTTP_TIMEOUT,
+        transport=MetricsTransport(metrics, httpx.HTTPTransport(limits=limits)),
+    )
+    http_async_client = httpx.AsyncClient(
+        timeout=settings.HTTP_TIMEOUT,
+        transport=AsyncMetricsTransport(
+            metrics, lambda: httpx.AsyncHTTPTransport(limits=limits)
+        ),
+    )
+    return http_client, http_async_client
+
+
+@cache
 def get_chat_llm():
+    if LLM_MODEL_PROVIDER not in ("openai", "azure_openai"):
+        return init_chat_model(model=LLM_MODEL, model_provider=LLM_MODEL_PROVIDER)
+
+    http_client, http_async_client = get_http_clients("llm")
     return init_chat_model(
         model=LLM_MODEL,
         model_provider=LLM_MODEL_PROVIDER,
+        http_client=http_client,
+        http_async_client=http_async_client,
     )
 
 
 def get_embedding_model():
     if "FAKE_API_KEY" in os.environ:
-        return FakeEmbeddings(size=3072)
+        return _get_embedding_model("fake")
     if "AZURE_OPENAI_API_KEY" in os.environ:
-        return AzureOpenAIEmbeddings(model=EMBEDDING_MODEL)
+        return _get_embedding_model("azure")
     if "OPENAI_API_KEY" in os.environ:
-        return OpenAIEmbeddings(model=EMBEDDING_MODEL)
+        return _get_embedding_model("openai")
     raise NotImplementedError("only Azure and OpenAI embeddings are supported")
 
 
+@cache
+def _get_embedding_model(provider: Literal["fake", "azure", "openai"]):
+    if provider == "fake":
+        return FakeEmbeddings(size=settings.EMBEDDING_DIMENSIONS or 3072)
+
+    embeddings_class = (
+        AzureOpenAIEmbeddings if provider == "azure" else OpenAIEmbeddings
+    )
+    http_client, http_async_client = get_http_clients("embedding")
+    return embeddings_class(
+        model=EMBEDDING_MODEL,
+        dimensions=settings.EMBEDDING_DIMENSIONS,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+
+
+class QueryEmbeddingCache:
+    """Caches query embeddings, keyed by embedding model, dimensions and normalised
+    query, in a bounded in-process LRU and, if QUERY_EMBEDDING_CACHE names one, a
+    shared django cache"""
+
+    def __init__(self):
+        self._lru: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: Counter[str] = Counter()
+        self.misses = 0
+
+    @staticmethod
+    def key(query: str) -> str:
+        normalised_query = " ".join(query.casefold().split())
+        digest = hashlib.sha256(
+            f"{EMBEDDING_MODEL}:{settings.EMBEDDING_DIMENSIONS}:{normalised_query}".encode()
+        )
+        return f"query-embedding:{digest.hexdigest()}"
+
+    def _get_local(self, key: str) -> list[float] | None:
+        with self._lock:
+            if (embedding := self._lru.get(key)) is not None:
+                self._lru.move_to_end(key)
+                self.hits["local"] += 1
+            return embedding
+
+    def _count(self, hit: str | None):
+        """count a hit of the "shared" cache, or a miss"""
+        with self._lock:
+            if hit:
+                self.hits[hit] += 1
+            else:
+                self.misses += 1
+
+    def _set_local(self, key: str, embedding: list[float]):
+        with self._lock:
+            self._lru[key] = embedding
+            while len(self._lru) > settings.QUERY_EMBEDDING_CACHE_SIZE:
+                self._lru.popitem(last=False)
+
+    @staticmethod
+    def _shared_cache():
+        if settings.QUERY_EMBEDDING_CACHE:
+            return caches[settings.QUERY_EMBEDDING_CACHE]
+        return None
+
+    def embed_query(self, query: str) -> list[float]:
+        key = self.key(query)
+        if (embedding := self._get_local(key)) is not None:
+            return embedding
+
+        shared_cache = self._shared_cache()
+        if shared_cache and (embedding := shared_cache.get(key)) is not None:
+            self._count("shared")
+        else:
+            self._count(None)
+            embedding = get_embedding_model().embed_query(query)
+            if shared_cache:
+                shared_cache.set(key, embedding)
+
+        self._set_local(key, embedding)
+        return embedding
+
+    async def aembed_query(self, query: str) -> list[float]:
+        """as embed_query, the embedding model is called with its async client"""
+        key = self.key(query)
+        if (embedding := self._get_local(key)) is not None:
+            return embedding
+
+        shared_cache = self._shared_cache()
+        if shared_cache and (embedding := await shared_cache.aget(key)) is not None:
+            self._count("shared")
+        else:
+            self._count(None)
+            embedding = await get_embedding_model().aembed_query(query)
+            if shared_cache:
+                await shared_cache.aset(key, embedding)
+
+        self._set_local(key, embedding)
+        return embedding
+
+    def info(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "local_hits": self.hits["local"],
+                "shared_hits": self.hits["shared"],
+                "misses": self.misses,
+                "size": len(self._lru),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+
+
+query_embedding_cache = QueryEmbeddingCache()
+
+
 SYSTEM_PROMPT = """You are Malcom Tucker from In The Thick of it. You will be asked questions 
 from disgruntled civil servants. reply in character using Markdown"""
 
@@ -85,11 +341,152 @@ def citations(state):
     )
 
 
-def to_json(obj):
-    if isinstance(obj, dict):
-        return {k: to_json(v) for k, v in obj.items() if k != "user_id"}
-    if isinstance(obj, list):
-        return list(map(to_json, obj))
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+|\n+")
+WORD = re.compile(r"\w+")
+STOP_WORDS = frozenset(
+    "the and for are was were but not you your with this that from have has had "
+    "they them their there what which who will would can could should into than "
+    "then its our out all any been being also just".split()
+)
+
+
+def content_words(text: str) -> set[str]:
+    return {
+        word
+        for word in WORD.findall(text.casefold())
+        if len(word) > 2 and word not in STOP_WORDS
+    }
+
+
+class CitationMatcher:
+    """Cites sources for a response by matching each sentence of the response to the
+    source sentence it shares the most words with. Sentences are matched as soon as
+    they are complete so citations are ready when the response finishes streaming,
+    without a second call to the llm"""
+
+    def __init__(self, min_overlap: float | None = None, min_words: int = 3):
+        self.min_overlap = (
+            settings.CITATION_MIN_OVERLAP if min_overlap is None else min_overlap
+        )
+        self.min_words = min_words
+        self.sources: list[tuple[str, str, set[str]]] = []
+        self.start_response()
+
+    def start_response(self):
+        """discard the response so far, i.e. when the model is called again"""
+        self.buffer = ""
+        self.citations: list[Citation] = []
+
+    def add_sources(self, documents: list | None):
+        for document in documents or []:
+            if not isinstance(document, LangchainDocument):
+                continue
+            if reference := document.metadata.get("url"):
+                for sentence in SENTENCE_BREAK.split(document.page_content):
+                    if words := content_words(sentence):
+                        self.sources.append((reference, sentence.strip(), words))
+
+    def feed(self, text: str):
+        self.buffer += text
+        *sentences, self.buffer = SENTENCE_BREAK.split(self.buffer)
+        for sentence in sentences:
+            self.match(sentence)
+
+    def match(self, sentence: str):
+        sentence = sentence.strip()
+        words = content_words(sentence)
+        if len(words) < self.min_words or not self.sources:
+            return
+        reference, source_sentence, source_words = max(
+            self.sources, key=lambda source: len(words & source[2])
+        )
+        if len(words & source_words) / len(words) >= self.min_overlap:
+            self.citations.append(
+                Citation(
+                    text_in_answer=sentence,
+                    text_in_source=source_sentence,
+                    reference=reference,
+                )
+            )
+
+    def finish(self) -> CitationList:
+        self.match(self.buffer)
+        self.buffer = ""
+        return CitationList(citations=self.citations)
+
+
+def count_tokens(text: str) -> int:
+    """an approximate token count, ~4 characters per token, that needs no tokenizer"""
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
+    """a token bucket refilled at the rate per minute given by a setting, acquire
+    blocks until the amount can be spent, a rate of 0 is unlimited"""
+
+    def __init__(self, setting: str):
+        self.setting = setting
+        self.lock = threading.Lock()
+        self.available: float | None = None
+        self.updated_at = time.monotonic()
+
+    def acquire(self, amount: int):
+        rate = getattr(settings, self.setting) / 60
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if self.available is None:
+                self.available = rate * 60
+            self.available = min(
+                rate * 60, self.available + (now - self.updated_at) * rate
+            )
+            self.updated_at = now
+            # the bucket may go into debt, which later callers wait to pay off
+            self.available -= amount
+            wait = max(0.0, -self.available / rate)
+        if wait:
+            logger.info("rate limited %s for %.1fs", self.setting, wait)
+            time.sleep(wait)
+
+
+embedding_rate_limiter = RateLimiter("EMBEDDING_TOKENS_PER_MINUTE")
+
+
+SUMMARY_PROMPT = (
+    "Update the summary of a conversation with the messages that follow it. "
+    "Keep names, figures, documents and decisions that may be referred to later. "
+    "Reply with the summary only, in no more than {max_words} words."
+    "\n\nHere is the summary so far: {summary}"
+)
+
+
+def summarise(summary: str, messages: list[AnyMessage]) -> str:
+    """fold messages into the rolling summary of a conversation"""
+    prompt = ChatPromptTemplate.from_messages(
+        [("system", SUMMARY_PROMPT), MessagesPlaceholder("messages")]
+    )
+    chain = prompt | get_chat_llm() | StrOutputParser()
+    return chain.invoke(
+        {
+            "summary": summary or "(empty)",
+            "max_words": settings.CHAT_SUMMARY_MAX_WORDS,
+            "messages": messages,
+        }
+    )
+
+
+def encode_default(obj):
+    """serialises what orjson doesn't know natively, i.e. langchain documents and
+    messages, or any other pydantic model"""
+    if isinstance(obj, LangchainDocument):
+        return {"page_content": obj.page_content, "metadata": obj.metadata}
     if hasattr(obj, "model_dump"):
         return obj.model_dump()
-    return obj
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def encode_event(obj) -> bytes:
+    """an event as JSON bytes, dicts and lists are serialised as they are rather
+    than rebuilt"""
+    return orjson.dumps(obj, default=encode_default)
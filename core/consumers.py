@@ -1,7 +1,11 @@
+import asyncio
 from uuid import UUID
 
-from asgiref.sync import sync_to_async
+import orjson
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from django_q.tasks import async_task
+from langchain_core.documents import Document as LangchainDocument
 from langchain_core.messages import (
     SystemMessage,
     HumanMessage,
@@ -9,8 +13,21 @@ from langchain_core.messages import (
 from langgraph.prebuilt import create_react_agent
 from langgraph.prebuilt.chat_agent_executor import AgentState
 
-from core.ai_core import get_chat_llm, citations, SYSTEM_PROMPT, to_json
-from core.models import Chat, ChatMessage as ChatMessageModel, Citation as CitationModel
+from core.ai_core import (
+    get_chat_llm,
+    citations,
+    CitationMatcher,
+    SYSTEM_PROMPT,
+    encode_event,
+)
+from core.models import (
+    Chat,
+    ChatMessage as ChatMessageModel,
+    Citation as CitationModel,
+    Document as DocumentModel,
+    progress_group,
+    sync_to_worker,
+)
 from core.tools import (
     search_documents,
     list_documents,
@@ -24,31 +41,161 @@ class Schema(AgentState):
 
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """streams each answer to the browser as a small set of events:
+
+    - {"event": "token", "data": "..."}, a delta of the answer being written
+    - {"event": "tool_start", "name": "...", "data": {...}}, a tool and its input
+    - {"event": "tool_end", "name": "...", "data": {"sources": [...]}}, the urls found
+    - {"event": "citations", "data": [...]}, the citations of the answer
+    - {"event": "done", "data": {"annotated_content": "..."}}, the footnoted answer
+
+    and, at any time, the progress of the user's documents being processed:
+
+    - {"event": "document_progress", "data": {"name": "...", "status": "...", ...}}
+
+    events are sent as binary frames of utf-8 encoded JSON
+    """
+
+    graph = None
+    document_names: tuple[str, ...] | None = None
+    progress_group: str | None = None
+    token_buffer = ""
+    flush_timer: asyncio.Task | None = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_lock = asyncio.Lock()
+
     async def disconnect(self, close_code):
         # Handle disconnection
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+        if self.progress_group:
+            await self.channel_layer.group_discard(
+                self.progress_group, self.channel_name
+            )
         await self.close()
 
+    async def get_graph(self, user_id: UUID):
+        """the graph is compiled once per connection, and again only if the user's
+        documents, which the delete_document tool enumerates, have changed"""
+        document_names = tuple(
+            [
+                name
+                async for name in DocumentModel.objects.filter(
+                    user_id=user_id
+                ).values_list("file", flat=True)
+            ]
+        )
+        if self.graph is None or document_names != self.document_names:
+            agent = create_react_agent(
+                self.llm,
+                tools=[
+                    search_wikipedia,
+                    search_documents,
+                    list_documents,
+                    build_delete_document(document_names),
+                ],
+                state_schema=Schema,
+            )
+            if settings.CITATION_MODE == "llm":
+                self.graph = agent | {"citations": citations}
+            else:
+                self.graph = agent
+            self.document_names = document_names
+        return self.graph
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        return orjson.loads(text_data)
+
+    async def send_json(self, content, close=False):
+        await self.send(bytes_data=encode_event(content), close=close)
+
+    async def connect(self):
+        self.llm = get_chat_llm()
+        user = self.scope.get("user")
+        if user is not None and user.is_authenticated:
+            self.progress_group = progress_group(user.id)
+            await self.channel_layer.group_add(self.progress_group, self.channel_name)
+        await super().connect()
+
+    async def document_progress(self, event):
+        await self.send_json(
+            content={"event": "document_progress", "data": event["data"]}
+        )
+
+    async def save_citations(
+        self, answer: ChatMessageModel, citation_list
+    ) -> list[CitationModel]:
+        citations = CitationModel.locate(
+            answer.content,
+            [
+                CitationModel(
+                    chat_message=answer,
+                    text_in_answer=citation.text_in_answer,
+                    text_in_source=citation.text_in_source,
+                    reference=citation.reference,
+                    index=index,
+                )
+                for index, citation in enumerate(citation_list.citations, start=1)
+            ],
+        )
+        return await CitationModel.objects.abulk_create(citations)
+
+    async def send_token(self, content: str):
+        """token deltas are coalesced into slices that are sent at most
+        STREAM_COALESCE_INTERVAL seconds after their first delta, by a timer so that
+        they aren't held back while the model pauses, or as soon as they reach
+        STREAM_COALESCE_MAX_CHARS"""
+        self.token_buffer += content
+        if (
+            not settings.STREAM_COALESCE_INTERVAL
+            or len(self.token_buffer) >= settings.STREAM_COALESCE_MAX_CHARS
+        ):
+            await self.flush_tokens()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.create_task(
+                self.flush_tokens_after(settings.STREAM_COALESCE_INTERVAL)
+            )
+
+    async def flush_tokens_after(self, delay: float):
+        await asyncio.sleep(delay)
+        # once it is sending the timer isn't cancelled, flush_tokens waits for it
+        self.flush_timer = None
+        await self.flush_tokens()
+
+    async def flush_tokens(self):
+        """send the coalesced tokens, before any other event of the answer is sent: a
+        timer that hasn't fired is cancelled and awaited, and one that is sending
+        is waited for"""
+        if (flush_timer := self.flush_timer) is not None:
+            self.flush_timer = None
+            flush_timer.cancel()
+            await asyncio.gather(flush_timer, return_exceptions=True)
+        async with self.token_lock:
+            # the buffer is taken before sending, so that a delta isn't sent twice
+            tokens, self.token_buffer = self.token_buffer, ""
+            if tokens:
+                await self.send_json(content={"event": "token", "data": tokens})
+
     async def receive_json(self, content, **kwargs):
         chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
         user = self.scope["user"]
 
-        delete_document = await sync_to_async(build_delete_document)(user.id)
-        agent = create_react_agent(
-            get_chat_llm(),
-            tools=[search_wikipedia, search_documents, list_documents, delete_document],
-            state_schema=Schema,
-        )
-
-        graph = agent | {"citations": citations}
+        graph = await self.get_graph(user.id)
 
         message = HumanMessage.model_validate(content)
 
         chat = await Chat.objects.aget(id=chat_id)
 
-        await sync_to_async(ChatMessageModel.from_langchain)(chat=chat, message=message)
+        await ChatMessageModel.afrom_langchain(chat=chat, message=message)
 
-        messages = await sync_to_async(chat.to_langchain)()
+        messages = await chat.ato_langchain(settings.CHAT_HISTORY_TOKEN_BUDGET)
         answer: ChatMessageModel | None = None
+        saved_citations: list[CitationModel] = []
+        citation_matcher = CitationMatcher()
+        self.token_buffer = ""
 
         async for event in graph.astream_events(
             {
@@ -58,26 +205,88 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             stream_mode="values",
             version="v2",
         ):
-            await self.send_json(content=to_json(event))
-            if event["event"] == "on_chain_end" and event["name"] == "LangGraph":
+            if event["event"] == "on_chat_model_start":
+                citation_matcher.start_response()
+
+            elif event["event"] == "on_chat_model_stream":
+                chunk = event["data"]["chunk"].content
+                if isinstance(chunk, str) and chunk:
+                    citation_matcher.feed(chunk)
+                    await self.send_token(chunk)
+
+            elif event["event"] == "on_tool_start":
+                await self.flush_tokens()
+                await self.send_json(
+                    content={
+                        "event": "tool_start",
+                        "name": event["name"],
+                        "data": {
+                            key: value
+                            for key, value in event["data"].get("input", {}).items()
+                            if key != "user_id"
+                        },
+                    }
+                )
+
+            elif event["event"] == "on_tool_end":
+                await self.flush_tokens()
+                artifact = getattr(event["data"]["output"], "artifact", None)
+                citation_matcher.add_sources(artifact)
+                await self.send_json(
+                    content={
+                        "event": "tool_end",
+                        "name": event["name"],
+                        "data": {
+                            "sources": [
+                                document.metadata.get("url")
+                                for document in artifact or []
+                                if isinstance(document, LangchainDocument)
+                            ]
+                        },
+                    }
+                )
+
+            elif event["event"] == "on_chain_end" and event["name"] == "LangGraph":
+                await self.flush_tokens()
                 last_message = event["data"]["output"]["messages"][-1]
-                answer = await sync_to_async(ChatMessageModel.from_langchain)(
+                answer = await ChatMessageModel.afrom_langchain(
                     chat=chat, message=last_message
                 )
+                if settings.CITATION_MODE != "llm":
+                    citation_list = citation_matcher.finish()
+                    if (
+                        settings.CITATION_MODE == "hybrid"
+                        and not citation_list.citations
+                    ):
+                        citation_list = await citations.ainvoke(event["data"]["output"])
+                    saved_citations = await self.save_citations(answer, citation_list)
 
             elif event["event"] == "on_chain_end" and event["name"] == "citations":
-                for index, citation in enumerate(
-                    event["data"]["output"].citations, start=1
-                ):
-                    await CitationModel.objects.acreate(
-                        chat_message=answer,
-                        text_in_answer=citation.text_in_answer,
-                        text_in_source=citation.text_in_source,
-                        reference=citation.reference,
-                        index=index,
-                    )
-
-        annotated_content = await sync_to_async(answer.annotated_content)()
+                saved_citations = await self.save_citations(
+                    answer, event["data"]["output"]
+                )
+
+        await self.flush_tokens()
+        await self.send_json(
+            content={
+                "event": "citations",
+                "data": [
+                    {
+                        "index": citation.index,
+                        "text_in_answer": citation.text_in_answer,
+                        "text_in_source": citation.text_in_source,
+                        "reference": citation.reference,
+                    }
+                    for citation in saved_citations
+                ],
+            }
+        )
+
+        annotated_content = await answer.aannotated_content(saved_citations)
         await self.send_json(
             content={"event": "done", "data": {"annotated_content": annotated_content}}
         )
+
+        # after the answer is done, and not in the one thread-sensitive thread, so
+        # that the broker isn't waited for by this or any other chat
+        await sync_to_worker(async_task)(chat.update_summary)
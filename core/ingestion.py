@@ -0,0 +1,133 @@
+import hashlib
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+from django.conf import settings
+from django.core.files import File
+from langchain_core.documents import Document as LangchainDocument
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from markitdown import MarkItDown
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTTextContainer
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
+
+from core.ai_core import EMBEDDING_MODEL
+
+PAGE_BREAK = "\f"
+HEADING = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+CODE_FENCE = re.compile(r"^\s*(```|~~~)")
+
+md = MarkItDown()
+
+
+def chunking_config() -> str:
+    """identifies the embedding model and chunking that embeddings are made with"""
+    return ":".join(
+        str(value)
+        for value in (
+            EMBEDDING_MODEL,
+            settings.CHUNK_UNIT,
+            settings.CHUNK_SIZE,
+            settings.CHUNK_OVERLAP,
+        )
+    )
+
+
+def embedding_config() -> str:
+    """identifies the embedding model, chunking and dimensions that embeddings are
+    made with, embeddings made with the same config can be shared between identical
+    files. The configs of full size embeddings are unchanged from before they could
+    be shortened."""
+    if not settings.EMBEDDING_DIMENSIONS:
+        return chunking_config()
+    return f"{chunking_config()}:{settings.EMBEDDING_DIMENSIONS}"
+
+
+@contextmanager
+def spool_file(file: File) -> Iterator[tuple[str, str]]:
+    """copy a file from storage to a local temporary file a chunk at a time, so it is
+    never held in memory, yielding the path and sha256 of the copy"""
+    digest = hashlib.sha256()
+    suffix = os.path.splitext(file.name)[1].lower()
+    with tempfile.NamedTemporaryFile(suffix=suffix) as local_file:
+        with file.open("rb"):
+            for chunk in file.chunks():
+                digest.update(chunk)
+                local_file.write(chunk)
+        local_file.flush()
+        yield local_file.name, digest.hexdigest()
+
+
+def count_pages(path: str) -> int | None:
+    """the number of pages of a pdf, without parsing them, None for other formats"""
+    if os.path.splitext(path)[1].lower() != ".pdf":
+        return None
+    with open(path, "rb") as local_file:
+        return resolve1(PDFDocument(PDFParser(local_file)).catalog["Pages"])["Count"]
+
+
+def convert_pages(path: str) -> Iterator[str]:
+    """the text of each page of a local file, pdfs are converted a page at a time,
+    other formats are converted whole by markitdown"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".pdf":
+        for page in extract_pages(path):
+            yield "".join(
+                element.get_text()
+                for element in page
+                if isinstance(element, LTTextContainer)
+            )
+    else:
+        text = md.convert_local(path, file_extension=extension).text_content
+        yield from text.split(PAGE_BREAK)
+
+
+def get_text_splitter() -> RecursiveCharacterTextSplitter:
+    if settings.CHUNK_UNIT == "tokens":
+        return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            chunk_size=settings.CHUNK_SIZE, chunk_overlap=settings.CHUNK_OVERLAP
+        )
+    return RecursiveCharacterTextSplitter(
+        chunk_size=settings.CHUNK_SIZE, chunk_overlap=settings.CHUNK_OVERLAP
+    )
+
+
+def split_sections(text: str) -> Iterator[tuple[list[str], str]]:
+    """split markdown on its headings, yielding the heading trail and body of each section"""
+    headings: list[str] = []
+    lines: list[str] = []
+    in_code_block = False
+
+    for line in text.splitlines(keepends=True):
+        if CODE_FENCE.match(line):
+            in_code_block = not in_code_block
+        elif not in_code_block and (match := HEADING.match(line)):
+            if "".join(lines).strip():
+                yield list(headings), "".join(lines)
+            level = len(match.group(1))
+            headings = headings[: level - 1] + [match.group(2)]
+            lines = []
+        lines.append(line)
+
+    if "".join(lines).strip():
+        yield list(headings), "".join(lines)
+
+
+def split_pages(
+    pages: Iterable[str], metadata: dict | None = None
+) -> Iterator[LangchainDocument]:
+    """split pages of converted text into overlapping passages as the pages arrive,
+    recording the page number and the section headings each passage falls under"""
+    text_splitter = get_text_splitter()
+
+    for page_number, page in enumerate(pages, start=1):
+        for headings, section in split_sections(page):
+            passage_metadata = {**(metadata or {}), "page_number": page_number}
+            if headings:
+                passage_metadata["section"] = " > ".join(headings)
+            yield from text_splitter.create_documents([section], [passage_metadata])
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.lookups import GreaterThan, LessThan
+
+from core.ingestion import chunking_config, embedding_config
+from core.models import Document, Projection, VectorDims
+
+
+class Command(BaseCommand):
+    help = """shorten stored embeddings to EMBEDDING_DIMENSIONS, a document at a
+    time. Embeddings can't be lengthened, those shorter than EMBEDDING_DIMENSIONS
+    are reported and need to be made again with reembed_documents --all. The space
+    is reclaimed by a VACUUM. The embedding config of documents made with the
+    current model and chunking is updated to match."""
+
+    @staticmethod
+    def compacted_config(document: Document) -> str | None:
+        """the config of a document's embeddings once compacted, unless they were made
+        with another model or chunking, or were shortened and aren't any longer"""
+        chunking = chunking_config()
+        config = document.embedding_config or ""
+        if config != chunking and not config.startswith(f"{chunking}:"):
+            return None
+        shortened = config.removeprefix(chunking).split(":")[1:2] not in ([], ["None"])
+        if shortened and not settings.EMBEDDING_DIMENSIONS:
+            return None
+        return embedding_config()
+
+    def handle(self, *args, **options):
+        dimensions = settings.EMBEDDING_DIMENSIONS
+        too_short = 0
+
+        for document in Document.objects.order_by("created_at").iterator():
+            embeddings = document.embedding_set.all()
+            with transaction.atomic():
+                shortened = short = 0
+                if dimensions:
+                    shortened = embeddings.filter(
+                        GreaterThan(VectorDims("embedding"), dimensions)
+                    ).update(embedding=Projection("embedding", dimensions))
+                    short = embeddings.filter(
+                        LessThan(VectorDims("embedding"), dimensions)
+                    ).count()
+                    too_short += short
+                if not short and (config := self.compacted_config(document)):
+                    Document.objects.filter(pk=document.pk).update(
+                        embedding_config=config
+                    )
+            if shortened:
+                self.stdout.write(f"{document}: shortened {shortened}")
+
+        if too_short:
+            self.stderr.write(
+                f"{too_short} embeddings have fewer than {dimensions} dimensions, "
+                "make them again with: python manage.py reembed_documents --all"
+            )
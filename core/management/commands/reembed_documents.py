@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.ingestion import embedding_config
+from core.models import Document
+
+
+def reembed(pk) -> tuple[Document, bool]:
+    try:
+        document = Document.objects.get(pk=pk)
+        return document, document.reembed()
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = """make the embeddings of complete documents again, with the current
+    embedding model and chunking, those made with another config unless --all is
+    given. Embeddings are made into a shadow table, a batch at a time, and swapped
+    in once a document is done, so it can be stopped and run again to resume. The
+    requests to the embedding model are limited by EMBEDDING_TOKENS_PER_MINUTE."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true")
+        parser.add_argument("--user", help="only the documents of this email address")
+        parser.add_argument("--document", nargs="+", help="only these documents")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="the number of documents to re-embed at once",
+        )
+
+    def handle(self, *args, **options):
+        documents = Document.objects.filter(status=Document.STATUSES.COMPLETE)
+        if not options["all"]:
+            documents = documents.exclude(embedding_config=embedding_config())
+        if options["user"]:
+            documents = documents.filter(user__email=options["user"])
+        if options["document"]:
+            documents = documents.filter(pk__in=options["document"])
+        pks = list(documents.order_by("created_at").values_list("pk", flat=True))
+
+        reembedded = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            futures = {executor.submit(reembed, pk): pk for pk in pks}
+            for future in as_completed(futures):
+                try:
+                    document, swapped = future.result()
+                except Exception as e:
+                    self.stderr.write(f"{futures[future]}: {e}")
+                    continue
+                if swapped:
+                    reembedded += 1
+                    self.stdout.write(
+                        f"{document}: {document.embedding_count} embeddings"
+                    )
+                else:
+                    self.stdout.write(f"{document}: reprocessed, skipped")
+
+        self.stdout.write(f"re-embedded {reembedded} of {len(pks)} documents")
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:36
+
+import core.models
+import django.contrib.postgres.indexes
+import pgvector.django.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="embedding",
+            index=pgvector.django.indexes.HnswIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    core.models.Projection("embedding"), name="vector_cosine_ops"
+                ),
+                ef_construction=64,
+                m=16,
+                name="embedding_projection_hnsw",
+            ),
+        ),
+    ]
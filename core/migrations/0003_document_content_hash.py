@@ -0,0 +1,33 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0002_embedding_projection_hnsw"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="content_hash",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                help_text="sha256 of the file, used to reuse the embeddings of identical files",
+                max_length=64,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="embedding_config",
+            field=models.CharField(
+                blank=True,
+                help_text="embedding model and chunking config the embeddings were made with",
+                max_length=256,
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0003_document_content_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="summarised_until",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="when the last message included in the summary was created",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="summary",
+            field=models.TextField(
+                blank=True,
+                default="",
+                help_text="summary of the messages that no longer fit in the prompt",
+            ),
+        ),
+    ]
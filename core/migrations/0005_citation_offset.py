@@ -0,0 +1,21 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0004_chat_summary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="citation",
+            name="offset",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="where the footnote goes in the answer, just after `text_in_answer`",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:58
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def set_status(apps, schema_editor):
+    """documents were complete if they had embeddings, in error if they had an
+    error and otherwise still processing"""
+    Document = apps.get_model("core", "Document")
+    Document.objects.filter(processing_error__isnull=False).update(status="ERROR")
+    documents = Document.objects.filter(processing_error__isnull=True).annotate(
+        count=Count("embedding")
+    )
+    for document in documents.filter(count__gt=0).iterator():
+        document.status = "COMPLETE"
+        document.passage_count = document.embedding_count = document.count
+        document.save(update_fields=["status", "passage_count", "embedding_count"])
+    documents.filter(count=0).update(status="PROCESSING")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0005_citation_offset"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="embedding_count",
+            field=models.PositiveIntegerField(
+                default=0, help_text="number of passages that have been embedded"
+            ),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="passage_count",
+            field=models.PositiveIntegerField(
+                default=0, help_text="number of passages the file was split into"
+            ),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="processing_finished_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="processing_started_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("QUEUED", "Queued"),
+                    ("PROCESSING", "Processing"),
+                    ("COMPLETE", "Complete"),
+                    ("ERROR", "Error"),
+                ],
+                db_index=True,
+                default="QUEUED",
+                max_length=16,
+            ),
+        ),
+        migrations.RunPython(set_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:59
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_messages(apps, schema_editor):
+    Chat = apps.get_model("core", "Chat")
+    ChatMessage = apps.get_model("core", "ChatMessage")
+    messages = ChatMessage.objects.filter(chat=OuterRef("pk")).order_by().values("chat")
+    Chat.objects.update(
+        message_count=Coalesce(
+            Subquery(messages.annotate(count=Count("pk")).values("count")), 0
+        ),
+        last_message_at=Subquery(
+            messages.annotate(last=Max("created_at")).values("last")
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0006_document_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="last_message_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="chat",
+            index=models.Index(
+                fields=["user", "-last_message_at", "-id"],
+                name="chat_user_last_message_at",
+            ),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.15 on 2026-10-18 15:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0007_chat_last_message_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(
+                default=0, help_text="number of times processing has been attempted"
+            ),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="size",
+            field=models.PositiveBigIntegerField(
+                blank=True, help_text="size of the file in bytes", null=True
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.15 on 2026-10-18 15:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0008_document_size_attempts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="page_count",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="number of pages, if the format has them",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.1.15 on 2026-10-18 15:11
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def backfill_search_vector(apps, schema_editor):
+    """set the search vectors of existing passages a batch at a time, each batch
+    committed on its own so that the rows aren't all locked until the end"""
+    with schema_editor.connection.cursor() as cursor:
+        while True:
+            cursor.execute(
+                """
+                UPDATE core_embedding SET search_vector = to_tsvector('english', text)
+                WHERE id IN (
+                    SELECT id FROM core_embedding WHERE search_vector IS NULL LIMIT %s
+                )
+                """,
+                [BACKFILL_BATCH_SIZE],
+            )
+            if cursor.rowcount < BACKFILL_BATCH_SIZE:
+                break
+
+
+class Migration(migrations.Migration):
+    # the backfill and the concurrent index build can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("core", "0009_document_page_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="embedding",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        migrations.RunSQL(
+            """
+            CREATE TRIGGER embedding_search_vector_update
+            BEFORE INSERT OR UPDATE OF text ON core_embedding
+            FOR EACH ROW EXECUTE FUNCTION
+            tsvector_update_trigger(search_vector, 'pg_catalog.english', text)
+            """,
+            "DROP TRIGGER embedding_search_vector_update ON core_embedding",
+        ),
+        migrations.RunPython(backfill_search_vector, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name="embedding",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="embedding_search_vector_gin"
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.15 on 2026-10-18 15:17
+
+import pgvector.django.bit
+import pgvector.django.vector
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0010_embedding_search_vector"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="embedding",
+            name="embedding_bits",
+            field=pgvector.django.bit.BitField(
+                blank=True,
+                help_text="the quantized projection, if EMBEDDING_QUANTIZATION is binary",
+                length=1024,
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="embedding",
+            name="embedding",
+            field=pgvector.django.vector.VectorField(),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.15 on 2026-10-18 15:20
+
+import django.db.models.deletion
+import pgvector.django.bit
+import pgvector.django.vector
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0011_embedding_dimensions_quantization"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ShadowEmbedding",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("embedding_config", models.CharField(max_length=256)),
+                ("embedding", pgvector.django.vector.VectorField()),
+                (
+                    "embedding_bits",
+                    pgvector.django.bit.BitField(blank=True, length=1024, null=True),
+                ),
+                ("text", models.TextField()),
+                ("index", models.PositiveIntegerField()),
+                ("metadata", models.JSONField()),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="core.document"
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["created_at"],
+                "abstract": False,
+            },
+        ),
+    ]
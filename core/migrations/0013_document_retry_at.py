@@ -0,0 +1,31 @@
+# Generated by Django 5.1.15 on 2026-10-18 15:38
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_processing_started_at(apps, schema_editor):
+    """documents left processing by 0006 have no start time, give them one so that
+    they are swept up once it has timed out"""
+    apps.get_model("core", "Document").objects.filter(
+        status="PROCESSING", processing_started_at=None
+    ).update(processing_started_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0012_shadowembedding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="retry_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="when processing may be attempted again",
+                null=True,
+            ),
+        ),
+        migrations.RunPython(set_processing_started_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.15 on 2026-10-18 16:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0013_document_retry_at"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="embedding",
+            name="embedding_bits",
+        ),
+        migrations.RemoveField(
+            model_name="shadowembedding",
+            name="embedding_bits",
+        ),
+    ]
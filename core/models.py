@@ -1,27 +1,107 @@
+import operator
+import re
 import textwrap
 import uuid
+from datetime import datetime
+from functools import reduce
+from itertools import batched, islice
 from logging import getLogger
-from typing import Self, Literal
+from typing import Callable, Iterable, Iterator, Self
 
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
 from django.contrib.auth.hashers import make_password
-from django.db import models
-from django.db.models import Count
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+    SearchVectorField,
+)
+from django.db import close_old_connections, connection, models, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce, Greatest
 from django.urls import reverse
-from langchain_core.messages import AnyMessage, AIMessage, HumanMessage
-from pgvector.django import VectorField, CosineDistance
+from django.utils import timezone
+from langchain_core.messages import (
+    AnyMessage,
+    AIMessage,
+    HumanMessage,
+    SystemMessage,
+)
+from django.contrib.postgres.indexes import OpClass
+from pgvector.django import VectorField, CosineDistance, HnswIndex
+from pgvector.utils import Vector
 from langchain_core.documents import Document as LangchainDocument
 
-from markitdown import MarkItDown
-
 
 from django.contrib.auth.models import AbstractUser, UserManager
 
-from core.ai_core import get_embedding_model
+from core.ai_core import (
+    content_words,
+    count_tokens,
+    embedding_rate_limiter,
+    get_embedding_model,
+    summarise,
+)
+from core.ingestion import (
+    convert_pages,
+    count_pages,
+    embedding_config,
+    spool_file,
+    split_pages,
+)
 
 
 logger = getLogger(__name__)
 
-md = MarkItDown()
+
+EMBEDDING_INDEX_DIMENSIONS = 1024
+TEXT_SEARCH_CONFIG = "english"
+
+
+def sync_to_worker(func: Callable) -> Callable:
+    """as sync_to_async, but in a worker thread rather than the one thread-sensitive
+    thread, for blocking calls that use nothing but their own database connection,
+    which is closed afterwards, as at the end of a request, if it is too old"""
+
+    def run(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def progress_group(user_id: uuid.UUID) -> str:
+    """the channel layer group that a user's document progress is sent to"""
+    return f"documents-{user_id}"
+
+
+def embed_passages(
+    passages: Iterable[LangchainDocument], start: int = 0
+) -> Iterator[list[dict]]:
+    """embed passages a batch at a time, skipping the first start of them, yielding
+    the fields of the embeddings of each batch"""
+    embedding_model = get_embedding_model()
+    for batch in batched(islice(passages, start, None), settings.EMBEDDING_BATCH_SIZE):
+        texts = [passage.page_content for passage in batch]
+        embedding_rate_limiter.acquire(sum(map(count_tokens, texts)))
+        embeddings = embedding_model.embed_documents(texts)
+        yield [
+            dict(
+                embedding=embedding,
+                text=passage.page_content,
+                index=index,
+                metadata=passage.metadata,
+            )
+            for index, (passage, embedding) in enumerate(
+                zip(batch, embeddings), start=start
+            )
+        ]
+        start += len(batch)
 
 
 class CoreUserManager(UserManager):
@@ -57,56 +137,230 @@ class User(AbstractUser, BaseModel):
 
     objects = CoreUserManager()
 
-    def get_history(self, limit: int = 10):
-        _history = (
-            Chat.objects.annotate(message_count=Count("chatmessage"))
-            .filter(user=self, message_count__gte=1)
-            .order_by("-created_at")[:limit]
-        )
-        return _history
+    def get_history(
+        self, limit: int = 10, before: tuple[datetime, uuid.UUID] | None = None
+    ):
+        """the user's chats with messages, most recently active first, a page at a
+        time: pass the (last_message_at, id) of the last chat of a page to get the
+        next one"""
+        _history = Chat.objects.filter(user=self, last_message_at__isnull=False)
+        if before is not None:
+            last_message_at, pk = before
+            _history = _history.filter(
+                Q(last_message_at__lt=last_message_at)
+                | Q(last_message_at=last_message_at, pk__lt=pk)
+            )
+        return _history.order_by("-last_message_at", "-pk")[:limit]
 
 
 class Document(BaseModel):
+    class STATUSES(models.TextChoices):
+        QUEUED = "QUEUED"
+        PROCESSING = "PROCESSING"
+        COMPLETE = "COMPLETE"
+        ERROR = "ERROR"
+
     file = models.FileField(unique=True, upload_to="uploads")
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    status = models.CharField(
+        choices=STATUSES, default=STATUSES.QUEUED, max_length=16, db_index=True
+    )
     processing_error = models.TextField(
         blank=True, null=True, help_text="error encountered during processing"
     )
-
-    @property
-    def status(self) -> Literal["ERROR", "COMPLETE", "PROCESSING"]:
-        if self.processing_error is not None:
-            return "ERROR"
-        if self.embedding_set.exists():
-            return "COMPLETE"
-        return "PROCESSING"
+    passage_count = models.PositiveIntegerField(
+        default=0, help_text="number of passages the file was split into"
+    )
+    embedding_count = models.PositiveIntegerField(
+        default=0, help_text="number of passages that have been embedded"
+    )
+    processing_started_at = models.DateTimeField(blank=True, null=True)
+    processing_finished_at = models.DateTimeField(blank=True, null=True)
+    page_count = models.PositiveIntegerField(
+        blank=True, null=True, help_text="number of pages, if the format has them"
+    )
+    size = models.PositiveBigIntegerField(
+        blank=True, null=True, help_text="size of the file in bytes"
+    )
+    attempts = models.PositiveSmallIntegerField(
+        default=0, help_text="number of times processing has been attempted"
+    )
+    retry_at = models.DateTimeField(
+        blank=True, null=True, help_text="when processing may be attempted again"
+    )
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="sha256 of the file, used to reuse the embeddings of identical files",
+    )
+    embedding_config = models.CharField(
+        max_length=256,
+        blank=True,
+        null=True,
+        help_text="embedding model and chunking config the embeddings were made with",
+    )
 
     def __str__(self):
         return self.file.name
 
     def generate_elements(self):
+        self.status = self.STATUSES.PROCESSING
+        self.processing_error = None
+        self.processing_started_at = timezone.now()
+        self.processing_finished_at = None
+        self.save()
+        self.publish_progress()
         try:
             self._generate_elements()
-            self.processing_error = None
+            self.status = self.STATUSES.COMPLETE
         except Exception as e:
+            self.status = self.STATUSES.ERROR
             self.processing_error = str(e)
+        self.processing_finished_at = timezone.now()
         self.save()
+        self.publish_progress()
+
+    def publish_progress(self, page_number: int | None = None):
+        """send the progress of processing to the user's chats, through the channel
+        layer, page_number is the page that processing has reached"""
+        eta = None
+        if page_number and self.page_count and self.processing_started_at:
+            elapsed = (timezone.now() - self.processing_started_at).total_seconds()
+            eta = round(elapsed / page_number * (self.page_count - page_number))
+
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            async_to_sync(channel_layer.group_send)(
+                progress_group(self.user_id),
+                {
+                    "type": "document.progress",
+                    "data": {
+                        "id": str(self.pk),
+                        "name": self.file.name,
+                        "status": self.status,
+                        "page_number": page_number,
+                        "page_count": self.page_count,
+                        "embedding_count": self.embedding_count,
+                        "eta_seconds": eta,
+                        "error": self.processing_error,
+                    },
+                },
+            )
+        except Exception:
+            logger.exception("failed to publish the progress of %s", self)
 
     def _generate_elements(self):
-        text = md.convert(self.file.url)
+        if self.embedding_config != embedding_config():
+            # embeddings made with another model or chunking can't be resumed from
+            self.embedding_set.all().delete()
+            self.embedding_count = 0
+            self.embedding_config = embedding_config()
+
+        with spool_file(self.file) as (path, content_hash):
+            self.content_hash = content_hash
+            if not self.embedding_count and self._copy_embeddings():
+                return
+
+            self.page_count = count_pages(path)
+            # pages are converted, split and embedded a batch at a time, each batch
+            # is committed so that a retry can resume after the last one
+            passages = split_pages(convert_pages(path), {"filename": self.file.name})
+            count = self.embedding_count
+            for batch in embed_passages(passages, start=count):
+                with transaction.atomic():
+                    Embedding.objects.bulk_create(
+                        Embedding(document=self, **fields) for fields in batch
+                    )
+                    count += len(batch)
+                    self.embedding_count = count
+                    self.save(
+                        update_fields=[
+                            "embedding_count",
+                            "embedding_config",
+                            "content_hash",
+                            "page_count",
+                            "updated_at",
+                        ]
+                    )
+                self.publish_progress(page_number=batch[-1]["metadata"]["page_number"])
+        self.passage_count = count
+
+    def reembed(self) -> bool:
+        """make the embeddings again with the current model and chunking, into shadow
+        embeddings that are committed a batch at a time so that this can be resumed,
+        then swap them for the document's embeddings, returns whether they were
+        swapped, which they aren't if the document has been reprocessed meanwhile"""
+        config = embedding_config()
+        shadow_embeddings = self.shadowembedding_set.all()
+        shadow_embeddings.exclude(embedding_config=config).delete()
+
+        with spool_file(self.file) as (path, _):
+            passages = split_pages(convert_pages(path), {"filename": self.file.name})
+            for batch in embed_passages(passages, start=shadow_embeddings.count()):
+                ShadowEmbedding.objects.bulk_create(
+                    ShadowEmbedding(document=self, embedding_config=config, **fields)
+                    for fields in batch
+                )
+
+        with transaction.atomic():
+            document = Document.objects.select_for_update().get(pk=self.pk)
+            if document.status != self.STATUSES.COMPLETE:
+                # the document's embeddings are being made again anyway
+                shadow_embeddings.delete()
+                return False
+            # readers see either the old embeddings or the new ones, the rows are
+            # copied without leaving the database
+            self.embedding_set.all().delete()
+            passage_count = ShadowEmbedding.swap(self)
+            self.passage_count = self.embedding_count = passage_count
+            self.embedding_config = config
+            self.save(
+                update_fields=[
+                    "passage_count",
+                    "embedding_count",
+                    "embedding_config",
+                    "updated_at",
+                ]
+            )
+        return True
 
-        embeddings: list[list[float]] = get_embedding_model().embed_documents([text.text_content])
+    def _copy_embeddings(self) -> bool:
+        """reuse the embeddings of an identical file, if one has been processed"""
+        original = (
+            Document.objects.filter(
+                content_hash=self.content_hash,
+                embedding_config=self.embedding_config,
+                status=self.STATUSES.COMPLETE,
+                embedding_count__gt=0,
+            )
+            .exclude(pk=self.pk)
+            .first()
+        )
+        if original is None:
+            return False
 
-        for i, (text, embedding, metadata) in enumerate(
-            zip([text.text_content], embeddings, [{"filename": self.file.name}])
-        ):
-            Embedding.objects.create(
+        embeddings = (
+            Embedding(
                 document=self,
-                embedding=embedding,
-                text=text,
-                index=i,
-                metadata=metadata,
+                embedding=embedding.embedding,
+                text=embedding.text,
+                index=embedding.index,
+                metadata={**embedding.metadata, "filename": self.file.name},
             )
+            for embedding in original.embedding_set.iterator()
+        )
+        with transaction.atomic():
+            for batch in batched(embeddings, settings.EMBEDDING_BATCH_SIZE):
+                Embedding.objects.bulk_create(batch)
+        self.passage_count = original.passage_count
+        self.embedding_count = original.embedding_count
+        self.page_count = original.page_count
+        logger.info("reused embeddings of %s for %s", original, self)
+        return True
 
     @classmethod
     def delete_by_name(cls, user_id: uuid.UUID, exact_document_name: str) -> bool:
@@ -116,13 +370,59 @@ class Document(BaseModel):
             return False
         return True
 
+    @classmethod
+    async def adelete_by_name(
+        cls, user_id: uuid.UUID, exact_document_name: str
+    ) -> bool:
+        try:
+            document = await cls.objects.aget(user_id=user_id, file=exact_document_name)
+        except cls.DoesNotExist:
+            return False
+        await document.adelete()
+        return True
+
+
+class Projection(models.Func):
+    """the leading components of a vector, text-embedding-3 models are trained so
+    that these are a usable, if less precise, embedding in their own right"""
+
+    template = "((%(expressions)s)::real[])[1:%(dimensions)s]::vector(%(dimensions)s)"
+
+    def __init__(self, expression, dimensions: int = EMBEDDING_INDEX_DIMENSIONS):
+        super().__init__(
+            expression,
+            dimensions=dimensions,
+            output_field=VectorField(dimensions=dimensions),
+        )
+
+
+class VectorDims(models.Func):
+    function = "vector_dims"
+    output_field = models.IntegerField()
+
 
 class Embedding(BaseModel):
     document = models.ForeignKey(Document, on_delete=models.CASCADE)
-    embedding = VectorField(dimensions=3072)
+    # the number of dimensions depends on EMBEDDING_DIMENSIONS
+    embedding = VectorField()
     text = models.TextField()
     index = models.PositiveIntegerField()
     metadata = models.JSONField()
+    # set from the text by a trigger, as a generated column would be, but one of
+    # those can't be added without rewriting the table
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta(BaseModel.Meta):
+        indexes = [
+            # hnsw indexes are limited to 2000 dimensions so the projection is indexed
+            HnswIndex(
+                OpClass(Projection("embedding"), name="vector_cosine_ops"),
+                name="embedding_projection_hnsw",
+                m=16,
+                ef_construction=64,
+            ),
+            GinIndex(fields=["search_vector"], name="embedding_search_vector_gin"),
+        ]
 
     def get_uri(self):
         return reverse(
@@ -133,39 +433,403 @@ class Embedding(BaseModel):
         )
 
     def to_langchain(self) -> LangchainDocument:
+        """passages of documents that are still being processed, or that failed part
+        way through, are marked as partial"""
+        # hybrid search selects the document status along with the embedding
+        document_status = getattr(self, "document_status", None) or self.document.status
         return LangchainDocument(
             page_content=str(self.text),
-            metadata=dict(url=self.get_uri(), index=self.index),
+            metadata=dict(
+                self.metadata,
+                url=self.get_uri(),
+                index=self.index,
+                partial=document_status != Document.STATUSES.COMPLETE,
+            ),
         )
 
     @classmethod
     def search_by_vector(
-        cls, user_id: uuid.UUID, embedded_query: list[float], top_k_results: int = 3
+        cls,
+        user_id: uuid.UUID,
+        embedded_query: list[float],
+        top_k_results: int = 3,
+        ef_search: int | None = None,
     ) -> list:
+        """candidates are found with the hnsw index over the projected embeddings and
+        re-ranked by their distance to the full embeddings. The index scan isn't
+        filtered by user, if too few of the rows it finds are the user's, their
+        passages are searched exactly instead. Passages of documents that are still
+        being processed are included as they are committed. Embeddings of another
+        size than the query, left by a change of EMBEDDING_DIMENSIONS until they are
+        compacted or made again, are skipped"""
+        candidate_count = top_k_results * settings.EMBEDDING_SEARCH_CANDIDATES
+        projected_distance = CosineDistance(
+            Projection("embedding"), embedded_query[:EMBEDDING_INDEX_DIMENSIONS]
+        )
+        embeddings = cls.objects.alias(dimensions=VectorDims("embedding")).filter(
+            dimensions=len(embedded_query)
+        )
+        candidates = (
+            embeddings.filter(document__user_id=user_id)
+            .annotate(projected_distance=projected_distance)
+            .order_by("projected_distance")
+            .values("pk")[:candidate_count]
+        )
         results = (
-            cls.objects.filter(document__user_id=user_id)
+            embeddings.select_related("document")
             .annotate(distance=CosineDistance("embedding", embedded_query))
-            .order_by("distance")[:top_k_results]
+            .order_by("distance")
+        )
+
+        # the index scan returns at most ef_search rows
+        ef_search = max(ef_search or settings.HNSW_EF_SEARCH, candidate_count)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('hnsw.ef_search', %s, true)", [str(ef_search)]
+            )
+            found = list(results.filter(pk__in=candidates)[:top_k_results])
+            if len(found) < top_k_results:
+                found = list(results.filter(document__user_id=user_id)[:top_k_results])
+            return [result.to_langchain() for result in found]
+
+    @classmethod
+    def search(
+        cls,
+        user_id: uuid.UUID,
+        query: str,
+        embedded_query: list[float],
+        top_k_results: int = 3,
+        ef_search: int | None = None,
+    ) -> list[LangchainDocument]:
+        """hybrid search, the passages nearest the embedded query (as in
+        search_by_vector, searched exactly if the index finds too few) and those best
+        matching the words of the query, by full text search, are ranked together by
+        reciprocal rank fusion"""
+        candidate_count = top_k_results * settings.EMBEDDING_SEARCH_CANDIDATES
+        embedding_table = cls._meta.db_table
+        document_table = Document._meta.db_table
+        projected = Projection.template % {
+            "expressions": "e.embedding",
+            "dimensions": EMBEDDING_INDEX_DIMENSIONS,
+        }
+        sql = rf"""
+            WITH candidates AS (
+                SELECT e.id, e.embedding
+                FROM {embedding_table} e
+                JOIN {document_table} d ON d.id = e.document_id
+                WHERE d.user_id = %(user_id)s
+                    AND vector_dims(e.embedding) = %(query_dimensions)s
+                ORDER BY {projected} <=> %(projected_query)s::vector
+                LIMIT %(candidate_count)s
+            ), exact AS (
+                -- the index scan isn't filtered by user, it may find too few
+                SELECT e.id, e.embedding
+                FROM {embedding_table} e
+                JOIN {document_table} d ON d.id = e.document_id
+                WHERE d.user_id = %(user_id)s
+                    AND vector_dims(e.embedding) = %(query_dimensions)s
+                    AND (SELECT count(*) FROM candidates) < %(top_k_results)s
+                ORDER BY e.embedding <=> %(embedded_query)s::vector
+                LIMIT %(candidate_count)s
+            ), vector_ranks AS (
+                SELECT id, row_number() OVER (
+                    ORDER BY embedding <=> %(embedded_query)s::vector
+                ) AS rank
+                FROM (
+                    SELECT * FROM exact
+                    UNION ALL
+                    SELECT * FROM candidates WHERE NOT EXISTS (SELECT FROM exact)
+                ) AS c
+            ), text_ranks AS (
+                SELECT e.id, row_number() OVER (
+                    ORDER BY ts_rank_cd(e.search_vector, q.query) DESC
+                ) AS rank
+                FROM {embedding_table} e
+                JOIN {document_table} d ON d.id = e.document_id,
+                -- any of the words may match, passages with more rank higher, only
+                -- the quoted lexemes are kept so phrases and negations are ignored
+                (
+                    SELECT string_agg(
+                        '''' || replace(replace(lexeme, '\', '\\'), '''', '''''')
+                        || '''',
+                        ' | '
+                    )::tsquery AS query
+                    FROM unnest(
+                        tsvector_to_array(to_tsvector(%(config)s::regconfig, %(query)s))
+                    ) AS lexeme
+                ) AS q
+                WHERE d.user_id = %(user_id)s AND e.search_vector @@ q.query
+                ORDER BY rank
+                LIMIT %(candidate_count)s
+            )
+            -- only what to_langchain needs, not the embedding or search vector
+            SELECT e.id, e.document_id, e.text, e.index, e.metadata,
+                d.status AS document_status,
+                COALESCE(1.0 / (%(rrf_k)s + v.rank), 0)
+                + COALESCE(1.0 / (%(rrf_k)s + t.rank), 0) AS score
+            FROM vector_ranks v
+            FULL OUTER JOIN text_ranks t ON t.id = v.id
+            JOIN {embedding_table} e ON e.id = COALESCE(v.id, t.id)
+            JOIN {document_table} d ON d.id = e.document_id
+            ORDER BY score DESC
+            LIMIT %(top_k_results)s
+        """
+        params = {
+            "user_id": user_id,
+            "query": query,
+            "config": TEXT_SEARCH_CONFIG,
+            "embedded_query": Vector._to_db(embedded_query),
+            "query_dimensions": len(embedded_query),
+            "projected_query": Vector._to_db(
+                embedded_query[:EMBEDDING_INDEX_DIMENSIONS]
+            ),
+            "candidate_count": candidate_count,
+            "rrf_k": settings.SEARCH_RRF_K,
+            "top_k_results": top_k_results,
+        }
+
+        ef_search = max(ef_search or settings.HNSW_EF_SEARCH, candidate_count)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('hnsw.ef_search', %s, true)", [str(ef_search)]
+            )
+            return [result.to_langchain() for result in cls.objects.raw(sql, params)]
+
+    @classmethod
+    async def asearch(
+        cls,
+        user_id: uuid.UUID,
+        query: str,
+        embedded_query: list[float],
+        top_k_results: int = 3,
+        ef_search: int | None = None,
+    ) -> list[LangchainDocument]:
+        """as search, the async orm can't run a query in a transaction, which
+        setting hnsw.ef_search needs, so the search is run in a thread. It needs
+        nothing but its own connection, so it isn't run in the one thread-sensitive
+        thread, where every search of every chat would wait for those before it"""
+        return await sync_to_worker(cls.search)(
+            user_id, query, embedded_query, top_k_results, ef_search
         )
-        return [result.to_langchain() for result in results]
 
     def __str__(self):
         return f"{self.document.file.name}.{self.index}"
 
 
+class ShadowEmbedding(BaseModel):
+    """embeddings being made again, by manage.py reembed_documents, that will replace
+    those of their document once they are all made, they aren't indexed or searched"""
+
+    document = models.ForeignKey(Document, on_delete=models.CASCADE)
+    embedding_config = models.CharField(max_length=256)
+    embedding = VectorField()
+    text = models.TextField()
+    index = models.PositiveIntegerField()
+    metadata = models.JSONField()
+
+    @classmethod
+    def swap(cls, document: Document) -> int:
+        """move the shadow embeddings of a document into its embeddings, in the
+        caller's transaction, returning how many were moved"""
+        columns = ", ".join(
+            connection.ops.quote_name(field.column)
+            for field in cls._meta.concrete_fields
+            if field.name != "embedding_config"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH moved AS (
+                    DELETE FROM {cls._meta.db_table} WHERE document_id = %s
+                    RETURNING {columns}
+                )
+                INSERT INTO {Embedding._meta.db_table} ({columns})
+                SELECT {columns} FROM moved
+                """,
+                [document.pk],
+            )
+            return cursor.rowcount
+
+
 class Chat(BaseModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    summary = models.TextField(
+        blank=True,
+        default="",
+        help_text="summary of the messages that no longer fit in the prompt",
+    )
+    summarised_until = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="when the last message included in the summary was created",
+    )
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta(BaseModel.Meta):
+        indexes = [
+            models.Index(
+                fields=["user", "-last_message_at", "-id"],
+                name="chat_user_last_message_at",
+            )
+        ]
 
     def __str__(self):
         if first_message := self.chatmessage_set.first():
             return textwrap.shorten(first_message.content, 80, placeholder="...")
         return "..."
 
-    def to_langchain(self) -> list[AnyMessage]:
-        messages = [
-            chat_message.to_langchain() for chat_message in self.chatmessage_set.all()
-        ]
-        return messages
+    def recent_messages(self, token_budget: int) -> list["ChatMessage"]:
+        """the most recent messages that fit within the token_budget, always
+        including the latest one"""
+        messages = []
+        for message in self.chatmessage_set.order_by("-created_at").iterator(
+            chunk_size=20
+        ):
+            token_budget -= count_tokens(message.content)
+            if messages and token_budget < 0:
+                break
+            messages.append(message)
+        return messages[::-1]
+
+    async def arecent_messages(self, token_budget: int) -> list["ChatMessage"]:
+        """as recent_messages"""
+        messages = []
+        async for message in self.chatmessage_set.order_by("-created_at").aiterator(
+            chunk_size=20
+        ):
+            token_budget -= count_tokens(message.content)
+            if messages and token_budget < 0:
+                break
+            messages.append(message)
+        return messages[::-1]
+
+    def _relevant_candidates(self, text: str, before) -> models.QuerySet | None:
+        words = sorted(content_words(text))[:32]
+        if not words or not settings.CHAT_HISTORY_RELEVANT_MESSAGES:
+            return None
+        query = reduce(
+            operator.or_, (SearchQuery(word, config="english") for word in words)
+        )
+        return (
+            self.chatmessage_set.filter(created_at__lt=before)
+            .annotate(rank=SearchRank(SearchVector("content", config="english"), query))
+            .filter(rank__gt=0)
+            .order_by("-rank")[: settings.CHAT_HISTORY_RELEVANT_MESSAGES]
+        )
+
+    @staticmethod
+    def _fit_relevant(candidates, token_budget: int) -> list["ChatMessage"]:
+        messages = []
+        for message in candidates:
+            token_budget -= count_tokens(message.content)
+            if token_budget < 0:
+                break
+            messages.append(message)
+        return sorted(messages, key=lambda message: message.created_at)
+
+    def relevant_messages(
+        self, text: str, before, token_budget: int
+    ) -> list["ChatMessage"]:
+        """messages from before the recent ones that share words with the text, best
+        matches first while they fit within the token_budget, in chat order"""
+        candidates = self._relevant_candidates(text, before)
+        if candidates is None:
+            return []
+        return self._fit_relevant(candidates, token_budget)
+
+    async def arelevant_messages(
+        self, text: str, before, token_budget: int
+    ) -> list["ChatMessage"]:
+        """as relevant_messages"""
+        candidates = self._relevant_candidates(text, before)
+        if candidates is None:
+            return []
+        return self._fit_relevant(
+            [message async for message in candidates], token_budget
+        )
+
+    def _with_summary(self, messages: list["ChatMessage"]) -> list[AnyMessage]:
+        summary = []
+        if self.summary:
+            summary.append(
+                SystemMessage(
+                    content=f"Summary of the conversation so far:\n{self.summary}"
+                )
+            )
+        return summary + [message.to_langchain() for message in messages]
+
+    def to_langchain(self, token_budget: int | None = None) -> list[AnyMessage]:
+        """the messages of this chat, or if a token_budget is given: the summary of
+        older messages, those older messages relevant to the latest one and the
+        most recent messages that fit in the budget"""
+        if token_budget is None:
+            return [
+                chat_message.to_langchain()
+                for chat_message in self.chatmessage_set.all()
+            ]
+
+        recent = self.recent_messages(token_budget)
+        if not recent:
+            return []
+        relevant = self.relevant_messages(
+            recent[-1].content,
+            before=recent[0].created_at,
+            token_budget=token_budget // 4,
+        )
+        return self._with_summary(relevant + recent)
+
+    async def ato_langchain(self, token_budget: int | None = None) -> list[AnyMessage]:
+        """as to_langchain, with the async orm, so that consumers needn't wait on
+        the thread that sync code is run in"""
+        if token_budget is None:
+            return [
+                chat_message.to_langchain()
+                async for chat_message in self.chatmessage_set.all()
+            ]
+
+        recent = await self.arecent_messages(token_budget)
+        if not recent:
+            return []
+        relevant = await self.arelevant_messages(
+            recent[-1].content,
+            before=recent[0].created_at,
+            token_budget=token_budget // 4,
+        )
+        return self._with_summary(relevant + recent)
+
+    def update_summary(self, token_budget: int | None = None):
+        """fold the messages that have dropped out of the recent window into the
+        summary, each message is summarised once even if updates overlap. No lock
+        is held while the llm is called, so as not to hold up new messages, which
+        update the chat, instead an update that overlaps one saved meanwhile is
+        dropped, the next update picks up its messages"""
+        chat = Chat.objects.get(pk=self.pk)
+        recent = chat.recent_messages(
+            token_budget or settings.CHAT_HISTORY_TOKEN_BUDGET
+        )
+        if not recent:
+            return
+        messages = chat.chatmessage_set.filter(created_at__lt=recent[0].created_at)
+        if chat.summarised_until:
+            messages = messages.filter(created_at__gt=chat.summarised_until)
+        messages = list(messages)
+        if not messages:
+            return
+
+        summary = summarise(
+            chat.summary, [message.to_langchain() for message in messages]
+        )
+        summarised_until = messages[-1].created_at
+        updated = Chat.objects.filter(
+            pk=self.pk, summarised_until=chat.summarised_until
+        ).update(
+            summary=summary,
+            summarised_until=summarised_until,
+            updated_at=timezone.now(),
+        )
+        if updated:
+            self.summary, self.summarised_until = summary, summarised_until
 
 
 class ChatMessage(BaseModel):
@@ -178,6 +842,19 @@ class ChatMessage(BaseModel):
     content = models.TextField()
     type = models.CharField(choices=TYPES)
 
+    def save(self, *args, **kwargs):
+        """new messages are counted on their chat, so that it needn't be aggregated"""
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Chat.objects.filter(pk=self.chat_id).update(
+                message_count=F("message_count") + 1,
+                last_message_at=Greatest(
+                    Coalesce("last_message_at", self.created_at), self.created_at
+                ),
+            )
+
     @classmethod
     def from_langchain(cls, chat, message: AnyMessage) -> Self:
         instance = cls.objects.create(
@@ -185,6 +862,12 @@ class ChatMessage(BaseModel):
         )
         return instance
 
+    @classmethod
+    async def afrom_langchain(cls, chat, message: AnyMessage) -> Self:
+        return await cls.objects.acreate(
+            chat=chat, content=message.content, type=message.type
+        )
+
     def to_langchain(self) -> AnyMessage:
         if self.type == self.TYPES.AI:
             return AIMessage(content=str(self.content))
@@ -192,16 +875,40 @@ class ChatMessage(BaseModel):
             return HumanMessage(content=str(self.content))
         raise NotImplementedError
 
-    def annotated_content(self) -> str:
+    def annotated_content(self, citations: list["Citation"] | None = None) -> str:
+        """the content with a footnote for each citation, built in one pass over the
+        content from the citations' offsets, citations can be passed in to save
+        fetching them"""
         content = str(self.content)
+        if citations is None:
+            citations = list(self.citation_set.all())
+        citations = sorted(citations, key=lambda citation: citation.index)
+        Citation.locate(
+            content, [citation for citation in citations if citation.offset is None]
+        )
+        citations = [
+            citation
+            for citation in citations
+            if citation.offset is not None and citation.offset <= len(content)
+        ]
 
-        for citation in self.citation_set.all():
-            try:
-                content = citation.generate_footnote(content)
-            except ValueError:
-                pass
-
-        return content
+        parts = []
+        position = 0
+        for citation in sorted(citations, key=lambda citation: citation.offset):
+            parts.append(content[position : citation.offset])
+            parts.append(f"[^{citation.index}]")
+            position = citation.offset
+        parts.append(content[position:])
+        parts.extend(f"\n\n{citation.footnote}" for citation in citations)
+        return "".join(parts)
+
+    async def aannotated_content(
+        self, citations: list["Citation"] | None = None
+    ) -> str:
+        """as annotated_content"""
+        if citations is None:
+            citations = [citation async for citation in self.citation_set.all()]
+        return self.annotated_content(citations)
 
     def __str__(self):
         return textwrap.shorten(self.content, 64, placeholder="...")
@@ -220,8 +927,42 @@ class Citation(models.Model):
     )
     index = models.PositiveIntegerField()
 
-    def generate_footnote(self, content: str) -> str:
-        index = content.index(self.text_in_answer) + len(self.text_in_answer)
-        start = content[:index]
-        end = content[index:]
-        return f'{start}[^{self.index}]{end}\n\n[^{self.index}]: "{repr(self.text_in_source)[1:-1]}" [source]({self.reference})'
+    offset = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text="where the footnote goes in the answer, just after `text_in_answer`",
+    )
+
+    @classmethod
+    def locate(cls, content: str, citations: list[Self]) -> list[Self]:
+        """set the offset of each citation to the end of the first occurrence of its
+        text_in_answer, found with a single search of the content for all of them"""
+        texts = sorted(
+            {citation.text_in_answer for citation in citations} - {""},
+            key=len,
+            reverse=True,
+        )
+        ends: dict[str, int] = {}
+        if texts:
+            # a lookahead so that matches may overlap, at each position only the
+            # longest text matches so the texts that prefix it are checked too
+            prefixes = {
+                text: [
+                    other for other in texts if other != text and text.startswith(other)
+                ]
+                for text in texts
+            }
+            pattern = re.compile("(?=(%s))" % "|".join(map(re.escape, texts)))
+            for match in pattern.finditer(content):
+                for text in [match.group(1), *prefixes[match.group(1)]]:
+                    ends.setdefault(text, match.start() + len(text))
+                if len(ends) == len(texts):
+                    break
+
+        for citation in citations:
+            citation.offset = ends.get(citation.text_in_answer)
+        return citations
+
+    @property
+    def footnote(self) -> str:
+        return f'[^{self.index}]: "{repr(self.text_in_source)[1:-1]}" [source]({self.reference})'
@@ -0,0 +1,154 @@
+from datetime import timedelta
+from logging import getLogger
+from typing import Literal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import async_task
+
+from core.models import Document
+
+logger = getLogger(__name__)
+
+Queue = Literal["small", "large"]
+
+
+def get_queue(document: Document) -> Queue:
+    if (document.size or 0) > settings.INGESTION_LARGE_FILE_SIZE:
+        return "large"
+    return "small"
+
+
+def enqueue(queue: Queue):
+    """queue a task to ingest whichever document is next in line, large documents
+    go to their own cluster"""
+    async_task(
+        ingest_next_document, queue, cluster="large" if queue == "large" else None
+    )
+
+
+def enqueue_document(document: Document):
+    enqueue(get_queue(document))
+
+
+def get_timeout(queue: Queue) -> int:
+    if queue == "large":
+        return settings.Q_CLUSTER["ALT_CLUSTERS"]["large"]["timeout"]
+    return settings.Q_CLUSTER["timeout"]
+
+
+def in_queue(queue: Queue) -> Q:
+    size = Q(size__gt=settings.INGESTION_LARGE_FILE_SIZE)
+    return size if queue == "large" else ~size | Q(size=None)
+
+
+def claim_next_document(queue: Queue) -> Document | None:
+    """mark the next document in the queue as processing and return it, that is the
+    oldest queued document, that isn't waiting to be retried, of the user with
+    fewest documents being processed"""
+    in_progress = (
+        Document.objects.filter(
+            user=OuterRef("user"), status=Document.STATUSES.PROCESSING
+        )
+        .order_by()
+        .values("user")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+
+    with transaction.atomic():
+        document = (
+            Document.objects.filter(in_queue(queue), status=Document.STATUSES.QUEUED)
+            .filter(Q(retry_at=None) | Q(retry_at__lte=timezone.now()))
+            .annotate(in_progress=Coalesce(Subquery(in_progress), 0))
+            .order_by("in_progress", "created_at")
+            .select_for_update(skip_locked=True, of=("self",))
+            .first()
+        )
+        if document is None:
+            return None
+        document.status = Document.STATUSES.PROCESSING
+        document.processing_started_at = timezone.now()
+        document.retry_at = None
+        document.attempts += 1
+        document.save(
+            update_fields=[
+                "status",
+                "processing_started_at",
+                "retry_at",
+                "attempts",
+                "updated_at",
+            ]
+        )
+    return document
+
+
+def ingest_next_document(queue: Queue):
+    """ingest the next document in the queue, if it fails it is retried later, with
+    a delay that doubles with each attempt"""
+    document = claim_next_document(queue)
+    if document is None:
+        return
+
+    document.generate_elements()
+
+    if (
+        document.status == Document.STATUSES.ERROR
+        and document.attempts < settings.INGESTION_MAX_ATTEMPTS
+    ):
+        delay = settings.INGESTION_RETRY_DELAY * 2 ** (document.attempts - 1)
+        logger.warning(
+            "failed to ingest %s, attempt %s, retrying in %ss: %s",
+            document,
+            document.attempts,
+            delay,
+            document.processing_error,
+        )
+        document.status = Document.STATUSES.QUEUED
+        document.retry_at = timezone.now() + timedelta(seconds=delay)
+        document.save(update_fields=["status", "retry_at", "updated_at"])
+
+
+def sweep_documents():
+    """run every INGESTION_SWEEP_MINUTES by a django-q schedule: documents whose
+    worker timed out, or was killed, are queued again, or failed if that was their
+    last attempt, and a task is queued for each document whose retry is due"""
+    now = timezone.now()
+    for queue in ("small", "large"):
+        timed_out = now - timedelta(seconds=get_timeout(queue))
+        stale = Document.objects.filter(
+            in_queue(queue), status=Document.STATUSES.PROCESSING
+        ).filter(Q(processing_started_at__lt=timed_out) | Q(processing_started_at=None))
+        stale.filter(attempts__gte=settings.INGESTION_MAX_ATTEMPTS).update(
+            status=Document.STATUSES.ERROR,
+            processing_error="timed out",
+            processing_finished_at=now,
+            updated_at=now,
+        )
+        requeued = stale.update(status=Document.STATUSES.QUEUED, updated_at=now)
+        due = Document.objects.filter(
+            in_queue(queue), status=Document.STATUSES.QUEUED, retry_at__lte=now
+        ).update(retry_at=None, updated_at=now)
+
+        for _ in range(requeued + due):
+            enqueue(queue)
+        if requeued or due:
+            logger.info("swept %s timed out and %s due documents", requeued, due)
+
+
+def schedule_sweep(**kwargs):
+    """create or update the schedule that runs sweep_documents, after each migrate,
+    so that it follows INGESTION_SWEEP_MINUTES"""
+    Schedule.objects.update_or_create(
+        name="sweep_documents",
+        defaults={
+            "func": "core.scheduler.sweep_documents",
+            "schedule_type": Schedule.MINUTES,
+            "minutes": settings.INGESTION_SWEEP_MINUTES,
+            "repeats": -1,
+        },
+    )
@@ -1,69 +1,287 @@
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
 from logging import getLogger
 from typing import Annotated, Literal
 from uuid import UUID
 
+import requests
 import wikipedia
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
 from langchain_core.documents import Document
-from langchain_core.tools import tool
+from langchain_core.tools import StructuredTool, tool
 from langgraph.prebuilt import InjectedState
+from requests import RequestException
+from wikipedia.exceptions import WikipediaException
 
-from core.ai_core import get_embedding_model
+from core.ai_core import query_embedding_cache
 from core.models import Document as DocumentModel, Chat, Embedding
 
 logger = getLogger(__name__)
 User = get_user_model()
 
 
-@tool(response_format="content_and_artifact")
-def search_wikipedia(
+class WikipediaRequests:
+    """the wikipedia client makes its requests with requests.get, without a timeout,
+    so a hung request would hold a worker of wikipedia_executor indefinitely, this
+    stands in for the requests module to give each one a timeout. Each thread has
+    its own session, as sessions aren't thread-safe, that keeps connections alive
+    between its requests"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        if (session := getattr(self.local, "session", None)) is None:
+            session = self.local.session = requests.Session()
+        kwargs.setdefault("timeout", settings.WIKIPEDIA_TIMEOUT)
+        return session.get(url, **kwargs)
+
+
+@cache
+def use_wikipedia_requests():
+    """swap WikipediaRequests in for the wikipedia client's requests module, once,
+    when the client is first used rather than when this module is imported"""
+    wikipedia.wikipedia.requests = WikipediaRequests()
+
+
+wikipedia_executor = ThreadPoolExecutor(
+    max_workers=settings.WIKIPEDIA_MAX_WORKERS, thread_name_prefix="wikipedia"
+)
+
+
+def fetch_wikipedia_page(page_title: str) -> list[Document]:
+    """returns the non-empty sections of a wikipedia page"""
+    use_wikipedia_requests()
+    page = wikipedia.page(title=page_title, auto_suggest=False)
+    sections = []
+    for section in page.sections:
+        if section_content := page.section(section):
+            fragment = section.replace(" ", "_")
+            document = Document(
+                page_content=section_content,
+                metadata={
+                    "url": page.url + "#" + fragment,
+                    "title": page.title,
+                },
+            )
+            sections.append(document)
+    return sections
+
+
+def wikipedia_cache_key(kind: str, value: str) -> str:
+    return f"wikipedia:{kind}:{hashlib.sha256(value.encode()).hexdigest()}"
+
+
+def search_wikipedia_titles(query: str, results: int) -> list[str]:
+    cache = caches[settings.WIKIPEDIA_CACHE]
+    key = wikipedia_cache_key("search", f"{results}:{query}")
+    if (page_titles := cache.get(key)) is None:
+        use_wikipedia_requests()
+        try:
+            page_titles = wikipedia.search(query, results=results)
+        except (WikipediaException, RequestException) as e:
+            logger.warning("failed to search wikipedia query=%s: %s", query, e)
+            return []
+        cache.set(key, page_titles, settings.WIKIPEDIA_CACHE_TTL)
+    return page_titles
+
+
+def _content_chars(contents: list[str]) -> int:
+    return sum(len(content) + len("\n\n") for content in contents)
+
+
+def _append_sections(
+    sections: list[Document],
+    contents: list[str],
+    sources: list[Document],
+    doc_content_chars_max: int,
+):
+    content_chars = _content_chars(contents)
+    for section in sections:
+        if content_chars >= doc_content_chars_max:
+            break
+        contents.append(section.page_content)
+        sources.append(section)
+        content_chars += len(section.page_content) + len("\n\n")
+
+
+def _wikipedia_result(
+    contents: list[str], sources: list[Document], doc_content_chars_max: int
+) -> tuple[str, list[Document]]:
+    if not contents:
+        return "No good Wikipedia Search Result was found", []
+    return "\n\n".join(contents)[:doc_content_chars_max], sources
+
+
+def _search_wikipedia(
     query: str, top_k_results: int = 3, doc_content_chars_max: int = 4000
 ) -> tuple[str, list[Document]]:
     """Run Wikipedia search and get page summaries."""
-    page_titles = wikipedia.search(query, results=top_k_results)
-    contents = []
-    sources = []
+    page_titles = search_wikipedia_titles(query, top_k_results)
+
+    cache = caches[settings.WIKIPEDIA_CACHE]
+    keys = {
+        page_title: wikipedia_cache_key("page", page_title)
+        for page_title in page_titles
+    }
+    cached_pages = cache.get_many(keys.values())
+
+    # pages are fetched concurrently, any not fetched within the timeout are skipped
+    futures = {
+        page_title: wikipedia_executor.submit(fetch_wikipedia_page, page_title)
+        for page_title in page_titles
+        if keys[page_title] not in cached_pages
+    }
+    deadline = time.monotonic() + settings.WIKIPEDIA_TIMEOUT
+
+    contents: list[str] = []
+    sources: list[Document] = []
     for page_title in page_titles:
-        if page := wikipedia.page(title=page_title, auto_suggest=False):
-            for section in page.sections:
-                if section_content := page.section(section):
-                    contents.append(section_content)
-
-                    fragment = section.replace(" ", "_")
-                    document = Document(
-                        page_content=section_content,
-                        metadata={
-                            "url": page.url + "#" + fragment,
-                            "title": page.title,
-                        },
-                    )
-                    sources.append(document)
-    if not contents:
-        return "No good Wikipedia Search Result was found", []
+        future = futures.get(page_title)
+        if _content_chars(contents) >= doc_content_chars_max:
+            if future:
+                future.cancel()
+            continue
+        if future is None:
+            sections = cached_pages[keys[page_title]]
+        else:
+            try:
+                sections = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except TimeoutError:
+                future.cancel()
+                logger.warning("timed out fetching wikipedia page=%s", page_title)
+                continue
+            except (WikipediaException, RequestException) as e:
+                logger.warning("failed to fetch wikipedia page=%s: %s", page_title, e)
+                continue
+            cache.set(keys[page_title], sections, settings.WIKIPEDIA_CACHE_TTL)
 
-    return "\n\n".join(contents)[:doc_content_chars_max], sources
+        _append_sections(sections, contents, sources, doc_content_chars_max)
 
+    return _wikipedia_result(contents, sources, doc_content_chars_max)
 
-@tool(response_format="content_and_artifact")
-def search_documents(
+
+async def _asearch_wikipedia(
+    query: str, top_k_results: int = 3, doc_content_chars_max: int = 4000
+) -> tuple[str, list[Document]]:
+    """as _search_wikipedia, the wikipedia client is synchronous so its requests are
+    made in wikipedia_executor, and awaited, rather than blocking the event loop"""
+    page_titles = await asyncio.wrap_future(
+        wikipedia_executor.submit(search_wikipedia_titles, query, top_k_results)
+    )
+
+    cache = caches[settings.WIKIPEDIA_CACHE]
+    keys = {
+        page_title: wikipedia_cache_key("page", page_title)
+        for page_title in page_titles
+    }
+    cached_pages = await cache.aget_many(keys.values())
+
+    futures = {
+        page_title: asyncio.wrap_future(
+            wikipedia_executor.submit(fetch_wikipedia_page, page_title)
+        )
+        for page_title in page_titles
+        if keys[page_title] not in cached_pages
+    }
+    deadline = time.monotonic() + settings.WIKIPEDIA_TIMEOUT
+
+    contents: list[str] = []
+    sources: list[Document] = []
+    for page_title in page_titles:
+        future = futures.get(page_title)
+        if _content_chars(contents) >= doc_content_chars_max:
+            if future:
+                future.cancel()
+            continue
+        if future is None:
+            sections = cached_pages[keys[page_title]]
+        else:
+            try:
+                sections = await asyncio.wait_for(
+                    future, timeout=max(deadline - time.monotonic(), 0)
+                )
+            except TimeoutError:
+                logger.warning("timed out fetching wikipedia page=%s", page_title)
+                continue
+            except (WikipediaException, RequestException) as e:
+                logger.warning("failed to fetch wikipedia page=%s: %s", page_title, e)
+                continue
+            await cache.aset(keys[page_title], sections, settings.WIKIPEDIA_CACHE_TTL)
+
+        _append_sections(sections, contents, sources, doc_content_chars_max)
+
+    return _wikipedia_result(contents, sources, doc_content_chars_max)
+
+
+# tools have a coroutine as well as a function, so that the agent runs them on the
+# event loop rather than in a thread. Searches the llm makes at once run
+# concurrently, wikipedia in its executor and documents in worker threads, while
+# the async orm queries of the other tools still share the thread-sensitive thread
+search_wikipedia = StructuredTool.from_function(
+    func=_search_wikipedia,
+    coroutine=_asearch_wikipedia,
+    name="search_wikipedia",
+    response_format="content_and_artifact",
+)
+
+
+def _search_documents(
     user_id: Annotated[UUID, InjectedState("user_id")],
     query: str,
     top_k_results: int = 3,
 ) -> tuple[str, list[Document]]:
     """search users own documents for relevant sections"""
-    embedded_query = get_embedding_model().embed_query(query)
-    documents = Embedding.search_by_vector(user_id, embedded_query, top_k_results)
+    embedded_query = query_embedding_cache.embed_query(query)
+    documents = Embedding.search(user_id, query, embedded_query, top_k_results)
 
     logger.info(f"converted {len(documents)} docs to langchain")
     return "\n\n".join(document.page_content for document in documents), documents
 
 
-@tool(response_format="content_and_artifact")
-def list_documents(
+async def _asearch_documents(
+    user_id: UUID, query: str, top_k_results: int = 3
+) -> tuple[str, list[Document]]:
+    embedded_query = await query_embedding_cache.aembed_query(query)
+    documents = await Embedding.asearch(user_id, query, embedded_query, top_k_results)
+
+    logger.info(f"converted {len(documents)} docs to langchain")
+    return "\n\n".join(document.page_content for document in documents), documents
+
+
+search_documents = StructuredTool.from_function(
+    func=_search_documents,
+    coroutine=_asearch_documents,
+    name="search_documents",
+    response_format="content_and_artifact",
+)
+
+
+def _list_documents(
     user_id: Annotated[UUID, InjectedState("user_id")],
 ) -> tuple[str, list[dict[str, str]]]:
     """returns a list of the users documents by exact name"""
-    docs = list(DocumentModel.objects.filter(user_id=user_id))
+    docs = list(DocumentModel.objects.filter(user_id=user_id).only("file", "status"))
+    return _document_list(docs)
+
+
+async def _alist_documents(user_id: UUID) -> tuple[str, list[dict[str, str]]]:
+    docs = [
+        doc
+        async for doc in DocumentModel.objects.filter(user_id=user_id).only(
+            "file", "status"
+        )
+    ]
+    return _document_list(docs)
+
+
+def _document_list(docs: list[DocumentModel]) -> tuple[str, list[dict[str, str]]]:
     metadata = [
         {"uri": doc.file.url, "name": doc.file.name, "status": doc.status}
         for doc in docs
@@ -71,15 +289,21 @@ def list_documents(
     return "\n".join(doc.file.name for doc in docs), metadata
 
 
-def build_delete_document(user_id: UUID):
-    file_names = [
-        doc.file.name for doc in DocumentModel.objects.filter(user_id=user_id)
-    ]
+list_documents = StructuredTool.from_function(
+    func=_list_documents,
+    coroutine=_alist_documents,
+    name="list_documents",
+    response_format="content_and_artifact",
+)
+
 
+def build_delete_document(file_names: tuple[str, ...]):
+    """the tool only depends on the document names, offered to the llm as choices,
+    the user is taken from the graph's state"""
     file_name_type = Literal[*file_names] if file_names else str
 
-    @tool
     def delete_document(
+        user_id: Annotated[UUID, InjectedState("user_id")],
         exact_document_name: file_name_type,
     ) -> bool:
         """delete a document give the exact_document_name,
@@ -89,7 +313,14 @@ def build_delete_document(user_id: UUID):
             user_id=user_id, exact_document_name=exact_document_name
         )
 
-    return delete_document
+    async def adelete_document(user_id: UUID, exact_document_name: str) -> bool:
+        return await DocumentModel.adelete_by_name(
+            user_id=user_id, exact_document_name=exact_document_name
+        )
+
+    return StructuredTool.from_function(
+        func=delete_document, coroutine=adelete_document, name="delete_document"
+    )
 
 
 @tool
@@ -5,19 +5,22 @@ from charset_normalizer.md import getLogger
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
 from django.db import IntegrityError
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render, redirect
-from django_q.tasks import async_task
 
 from core.forms import LoginForm, UploadFileForm
 from core.models import Document, Chat, Embedding
+from core.scheduler import enqueue_document
 from sesame.utils import get_query_string
 
 logger = getLogger(__name__)
 User = get_user_model()
 
+HISTORY_PAGE_SIZE = 10
+
 
 @login_required
 def embedding_detail(request, pk: UUID):
@@ -42,9 +45,11 @@ def upload_file(request):
         if form.is_valid():
             try:
                 document = Document.objects.create(
-                    file=request.FILES["file"], user=request.user
+                    file=request.FILES["file"],
+                    user=request.user,
+                    size=request.FILES["file"].size,
                 )
-                async_task(document.generate_elements)
+                enqueue_document(document)
             except IntegrityError:
                 error = "file with this name already exists"
         else:
@@ -56,7 +61,19 @@ def upload_file(request):
 def chat_detail(request, pk: UUID):
     error = upload_file(request)
     chat = get_object_or_404(Chat, pk=pk, user=request.user)
-    chat_history = request.user.get_history()
+    before = None
+    if before_pk := request.GET.get("before"):
+        try:
+            before = (
+                Chat.objects.filter(pk=before_pk, user=request.user)
+                .values_list("last_message_at", "pk")
+                .first()
+            )
+        except ValidationError:
+            pass
+    chat_history = list(
+        request.user.get_history(limit=HISTORY_PAGE_SIZE, before=before)
+    )
 
     file_upload_form = UploadFileForm()
     return render(
@@ -65,6 +82,9 @@ def chat_detail(request, pk: UUID):
         {
             "chat": chat,
             "chat_history": chat_history,
+            "older_chats": chat_history[-1].pk
+            if len(chat_history) == HISTORY_PAGE_SIZE
+            else None,
             "scheme": settings.WEBSOCKET_SCHEME,
             "file_upload_form": file_upload_form,
             "error": error,
@@ -7,6 +7,7 @@ poetry run python manage.py collectstatic --noinput
 # Apply database migrations
 echo "Apply database migrations"
 poetry run python manage.py migrate
+poetry run python manage.py createcachetable
 
 # Start server
 echo "Starting server"
@@ -3,6 +3,7 @@ from logging import getLogger
 from pathlib import Path
 
 import boto3
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 logger = getLogger(__name__)
@@ -108,6 +109,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
 ]
 
 MIDDLEWARE = [
@@ -204,6 +206,18 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 ASGI_APPLICATION = "dosac.asgi.application"
 
+# the channel layer carries ingestion progress from the workers to the browser, it
+# has to be redis for that to cross processes, in memory it is only good for tests
+if os.environ.get("REDIS_URL"):
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [os.environ["REDIS_URL"]]},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
 
 AUTH_USER_MODEL = "core.User"
 
@@ -217,8 +231,32 @@ Q_CLUSTER = {
     "bulk": 10,
     "orm": "default",
     "max_attempts": 1,
+    # run with: Q_CLUSTER_NAME=large python manage.py qcluster
+    "ALT_CLUSTERS": {
+        "large": {
+            "workers": int(os.environ.get("LARGE_INGESTION_WORKERS", 2)),
+            "timeout": 60 * 60,
+            "retry": 60 * 61,
+        },
+    },
 }
 
+# uploads bigger than INGESTION_LARGE_FILE_SIZE bytes are ingested by the "large"
+# cluster so that they don't hold up smaller ones, failed ingestions are retried,
+# from the last embedded passage, up to INGESTION_MAX_ATTEMPTS times in all
+INGESTION_LARGE_FILE_SIZE = int(
+    os.environ.get("INGESTION_LARGE_FILE_SIZE", 5 * 1024 * 1024)
+)
+INGESTION_MAX_ATTEMPTS = int(os.environ.get("INGESTION_MAX_ATTEMPTS", 3))
+# a failed ingestion is retried INGESTION_RETRY_DELAY seconds later, doubling with
+# each attempt, queued documents that are due, and those whose worker timed out,
+# are swept up every INGESTION_SWEEP_MINUTES
+INGESTION_RETRY_DELAY = int(os.environ.get("INGESTION_RETRY_DELAY", 60))
+INGESTION_SWEEP_MINUTES = int(os.environ.get("INGESTION_SWEEP_MINUTES", 1))
+# the approximate number of tokens each worker process may send to the embedding
+# model per minute during ingestion, 0 is unlimited
+EMBEDDING_TOKENS_PER_MINUTE = int(os.environ.get("EMBEDDING_TOKENS_PER_MINUTE", 0))
+
 AUTHENTICATION_BACKENDS = [
     "django.contrib.auth.backends.ModelBackend",
     "sesame.backends.ModelBackend",
@@ -236,3 +274,90 @@ STORAGES = {
         "BACKEND": "storages.backends.s3boto3.S3Boto3Storage",
     },
 }
+
+# Documents are split into passages of CHUNK_SIZE characters (or tokens) before
+# being embedded, consecutive passages share CHUNK_OVERLAP characters (or tokens)
+CHUNK_UNIT = os.environ.get("CHUNK_UNIT", "characters")
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", 2000))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", 200))
+# number of passages sent to the embedding model, and inserted, per request
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 256))
+
+# embeddings are requested with EMBEDDING_DIMENSIONS dimensions, or the model's
+# default if 0, text-embedding-3 models can be shortened to as few as 1024 (the
+# number that are indexed) with little loss. Existing embeddings are shortened
+# with: python manage.py compact_embeddings
+EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", 0)) or None
+if EMBEDDING_DIMENSIONS and EMBEDDING_DIMENSIONS < 1024:
+    raise ImproperlyConfigured(
+        "EMBEDDING_DIMENSIONS must be at least 1024, the number that are indexed"
+    )
+
+# passages are searched for using an approximate nearest neighbour (hnsw) index,
+# top_k * EMBEDDING_SEARCH_CANDIDATES candidates are re-ranked by exact distance
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 100))
+EMBEDDING_SEARCH_CANDIDATES = int(os.environ.get("EMBEDDING_SEARCH_CANDIDATES", 10))
+# search_documents fuses the ranks of vector and full text search, each passage
+# scoring 1 / (SEARCH_RRF_K + rank) for each search it is found by
+SEARCH_RRF_K = int(os.environ.get("SEARCH_RRF_K", 60))
+
+# the "shared" cache is a postgres table, created with `manage.py createcachetable`,
+# so that it is shared between the web and worker processes
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "shared": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "core_cache",
+        "TIMEOUT": 60 * 60 * 24 * 7,
+    },
+    "wikipedia": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "wikipedia",
+        "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("WIKIPEDIA_CACHE_SIZE", 1000))},
+    },
+}
+
+# query embeddings are cached in an in-process LRU of QUERY_EMBEDDING_CACHE_SIZE
+# entries, and in QUERY_EMBEDDING_CACHE (i.e. "shared") if it is set
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+QUERY_EMBEDDING_CACHE = os.environ.get("QUERY_EMBEDDING_CACHE")
+
+# each model has its own pool of keep-alive connections, shared across the process,
+# the pool size bounds the number of concurrent requests made to the model
+HTTP_MAX_CONNECTIONS = {
+    "llm": int(os.environ.get("LLM_MAX_CONNECTIONS", 20)),
+    "embedding": int(os.environ.get("EMBEDDING_MAX_CONNECTIONS", 10)),
+}
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 60))
+
+# wikipedia pages are fetched concurrently, those taking longer than
+# WIKIPEDIA_TIMEOUT seconds are left out of the results
+WIKIPEDIA_MAX_WORKERS = int(os.environ.get("WIKIPEDIA_MAX_WORKERS", 8))
+WIKIPEDIA_TIMEOUT = float(os.environ.get("WIKIPEDIA_TIMEOUT", 10))
+# searches and pages are cached for WIKIPEDIA_CACHE_TTL seconds, in process or, if
+# WIKIPEDIA_CACHE=shared, in postgres
+WIKIPEDIA_CACHE = os.environ.get("WIKIPEDIA_CACHE", "wikipedia")
+WIKIPEDIA_CACHE_TTL = int(os.environ.get("WIKIPEDIA_CACHE_TTL", 60 * 60 * 24))
+
+# citations are found by matching the words of each sentence of the response to
+# the sources as it streams ("lexical"), "hybrid" falls back to asking the llm
+# if none are found and "llm" always asks the llm once the response is complete
+CITATION_MODE = os.environ.get("CITATION_MODE", "lexical")
+CITATION_MIN_OVERLAP = float(os.environ.get("CITATION_MIN_OVERLAP", 0.6))
+
+# only the most recent messages that fit in CHAT_HISTORY_TOKEN_BUDGET are sent to the
+# llm, older ones are folded into a summary of the chat in the background and up to
+# CHAT_HISTORY_RELEVANT_MESSAGES of them that match the latest message are included
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", 8000))
+CHAT_HISTORY_RELEVANT_MESSAGES = int(
+    os.environ.get("CHAT_HISTORY_RELEVANT_MESSAGES", 3)
+)
+CHAT_SUMMARY_MAX_WORDS = int(os.environ.get("CHAT_SUMMARY_MAX_WORDS", 300))
+
+# token deltas are streamed to the browser in slices sent at most
+# STREAM_COALESCE_INTERVAL seconds after their first delta, or once they reach
+# STREAM_COALESCE_MAX_CHARS characters, an interval of 0 sends each delta as it arrives
+STREAM_COALESCE_INTERVAL = float(os.environ.get("STREAM_COALESCE_INTERVAL", 0))
+STREAM_COALESCE_MAX_CHARS = int(os.environ.get("STREAM_COALESCE_MAX_CHARS", 256))
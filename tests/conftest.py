@@ -1,12 +1,25 @@
+import json
 import math
 import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock, patch
+from urllib.parse import parse_qs, urlparse
 
 import pytest
 import pytest_asyncio
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
 from django.core.files.uploadedfile import SimpleUploadedFile
+from langchain_core.embeddings import FakeEmbeddings
 from langchain_core.language_models import GenericFakeChatModel
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
 
+from core.ai_core import query_embedding_cache
 from core.models import Chat, ChatMessage, Document, Embedding
 
 User = get_user_model()
@@ -26,6 +39,20 @@ def fake_embeddings():
     yield
 
 
+@pytest.fixture
+def embedding_model():
+    """fake embeddings that record how they're called, passages and queries are
+    embedded with them, a side_effect that returns DEFAULT falls through to them"""
+    query_embedding_cache.clear()
+    model = Mock(wraps=FakeEmbeddings(size=3072))
+    with (
+        patch("core.ai_core.get_embedding_model", return_value=model),
+        patch("core.models.get_embedding_model", return_value=model),
+    ):
+        yield model
+    query_embedding_cache.clear()
+
+
 @pytest.fixture
 def user():
     _user = User.objects.create(email="whatever@somewhere.com")
@@ -68,6 +95,49 @@ def file():
     yield SimpleUploadedFile(name="hello.txt", content=b"hello!")
 
 
+def make_pdf(pages: list[str]) -> bytes:
+    """a minimal pdf with a line of text on each page"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [%s] /Count %d >>"
+        % (
+            b" ".join(b"%d 0 R" % (4 + 2 * i) for i in range(len(pages))),
+            len(pages),
+        ),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, text in enumerate(pages):
+        stream = b"BT /F1 12 Tf 72 720 Td (%s) Tj ET" % text.encode()
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (5 + 2 * i)
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return pdf
+
+
+@pytest.fixture
+def pdf_file():
+    yield SimpleUploadedFile(
+        name="hello.pdf", content=make_pdf(["hello page one", "hello page two"])
+    )
+
+
 @pytest.fixture
 def user_document(user, file):
     document = Document.objects.create(user=user, file=file)
@@ -85,10 +155,27 @@ def user_embedded_document(user_document):
             index=index,
             metadata={"page_number": 1},
         )
+    user_document.status = Document.STATUSES.COMPLETE
+    user_document.passage_count = user_document.embedding_count = 10
+    user_document.save()
 
     yield user_document
 
 
+@pytest.fixture
+def long_document(user, settings):
+    """a document split into many short passages that are embedded 4 at a time"""
+    settings.CHUNK_SIZE = 20
+    settings.CHUNK_OVERLAP = 0
+    settings.EMBEDDING_BATCH_SIZE = 4
+    document = Document.objects.create(
+        user=user,
+        file=SimpleUploadedFile(name="long.txt", content=b"hello world! " * 20),
+    )
+    yield document
+    document.delete()
+
+
 @pytest.fixture
 def user_with_many_chat_messages(user):
     chats = [Chat.objects.create(user=user) for _ in range(10)]
@@ -118,6 +205,95 @@ def user_with_many_documents(user):
         document.delete()
 
 
+def wikipedia_api(params: dict[str, str]) -> dict:
+    """the parts of the mediawiki api used by the wikipedia client"""
+    if params.get("list") == "search":
+        titles = ["Cabinet Office", "Slow"][: int(params["srlimit"])]
+        return {"query": {"search": [{"title": title} for title in titles]}}
+
+    title = params.get("titles") or params.get("page")
+    if title == "Slow":
+        time.sleep(1)
+    if params.get("action") == "parse":
+        return {"parse": {"sections": [{"line": "History"}, {"line": "Functions"}]}}
+    if params.get("prop") == "info|pageprops":
+        return {
+            "query": {
+                "pages": {
+                    "1": {
+                        "title": title,
+                        "fullurl": f"https://en.wikipedia.org/wiki/{title}",
+                    }
+                }
+            }
+        }
+    return {
+        "query": {
+            "pages": {
+                "1": {
+                    "extract": f"== History ==\n{title} history\n== Functions ==\n{title} functions",
+                    "revisions": [{"revid": 1, "parentid": 0}],
+                }
+            }
+        }
+    }
+
+
+class WikipediaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.request_count += 1
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        body = json.dumps(wikipedia_api({k: v[0] for k, v in query.items()}))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def wikipedia_server():
+    caches[settings.WIKIPEDIA_CACHE].clear()
+    server = ThreadingHTTPServer(("localhost", 0), WikipediaHandler)
+    server.request_count = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with patch(
+        "wikipedia.wikipedia.API_URL", f"http://localhost:{server.server_port}/"
+    ):
+        yield server
+    server.shutdown()
+    server.server_close()
+
+
 class FakeChatModel(GenericFakeChatModel):
     def bind_tools(self, tools, **kwargs):
         return self
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        """like GenericFakeChatModel but streams tool calls too"""
+        message = next(self.messages)
+        chunks = [
+            AIMessageChunk(content=token)
+            for token in re.split(r"(\s)", message.content)
+        ]
+        if message.tool_calls:
+            chunks.append(
+                AIMessageChunk(
+                    content="",
+                    tool_call_chunks=[
+                        {
+                            "name": tool_call["name"],
+                            "args": json.dumps(tool_call["args"]),
+                            "id": tool_call["id"],
+                            "index": index,
+                        }
+                        for index, tool_call in enumerate(message.tool_calls)
+                    ],
+                )
+            )
+        for chunk in chunks:
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.content, chunk=chunk)
+            yield ChatGenerationChunk(message=chunk)
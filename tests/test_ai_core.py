@@ -1,12 +1,34 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import httpx
+import orjson
+import pytest
+from django.core.cache import caches
+from langchain_core.documents import Document
 from langchain_core.messages import AIMessage
 
-from core.ai_core import to_json
+from core.ai_core import (
+    Citation,
+    CitationMatcher,
+    AsyncMetricsTransport,
+    ClientMetrics,
+    MetricsTransport,
+    RateLimiter,
+    client_metrics,
+    get_chat_llm,
+    get_embedding_model,
+    get_http_clients,
+    query_embedding_cache,
+    encode_event,
+)
 
 
-def test_to_json():
+def test_encode_event():
     messages = {
         "messages": [AIMessage(content="hello")],
-        "user_id": "1",
+        "documents": [Document(page_content="hi", metadata={"index": 1})],
         "another_thing": 2,
     }
     expected = {
@@ -24,6 +46,183 @@ def test_to_json():
                 "usage_metadata": None,
             }
         ],
+        "documents": [{"page_content": "hi", "metadata": {"index": 1}}],
         "another_thing": 2,
     }
-    assert to_json(messages) == expected
+    assert orjson.loads(encode_event(messages)) == expected
+
+
+def test_query_embedding_cache(embedding_model, settings):
+    settings.QUERY_EMBEDDING_CACHE = None
+    first = query_embedding_cache.embed_query("What is  the Cabinet Office?")
+    second = query_embedding_cache.embed_query("what is the cabinet office?")
+
+    assert first == second
+    assert embedding_model.embed_query.call_count == 1
+
+    settings.EMBEDDING_DIMENSIONS = 1024
+    query_embedding_cache.embed_query("what is the cabinet office?")
+    assert embedding_model.embed_query.call_count == 2
+
+
+def test_query_embedding_cache_eviction(embedding_model, settings):
+    settings.QUERY_EMBEDDING_CACHE = None
+    settings.QUERY_EMBEDDING_CACHE_SIZE = 2
+    for query in ["one", "two", "three", "one"]:
+        query_embedding_cache.embed_query(query)
+
+    assert embedding_model.embed_query.call_count == 4
+    assert query_embedding_cache.info()["size"] == 2
+
+
+def test_query_embedding_cache_counts_across_threads(embedding_model, settings):
+    settings.QUERY_EMBEDDING_CACHE = "default"
+    settings.QUERY_EMBEDDING_CACHE_SIZE = 0
+    caches["default"].clear()
+    before = query_embedding_cache.info()
+    queries = [f"query {i}" for i in range(50)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(query_embedding_cache.embed_query, queries * 2))
+
+    after = query_embedding_cache.info()
+    misses = after["misses"] - before["misses"]
+    assert misses + after["shared_hits"] - before["shared_hits"] == 100
+    assert misses == embedding_model.embed_query.call_count
+
+
+def test_query_embedding_cache_shared(embedding_model, settings):
+    settings.QUERY_EMBEDDING_CACHE = "default"
+    caches["default"].clear()
+    query_embedding_cache.embed_query("hello")
+    query_embedding_cache.clear()
+    hits = query_embedding_cache.info()["shared_hits"]
+    query_embedding_cache.embed_query("hello")
+
+    assert embedding_model.embed_query.call_count == 1
+    assert query_embedding_cache.info()["shared_hits"] == hits + 1
+
+
+def handle_metrics_request(request: httpx.Request) -> httpx.Response:
+    if request.url.path == "/timeout":
+        raise httpx.ConnectTimeout("timed out", request=request)
+    return httpx.Response(500 if request.url.path == "/error" else 200)
+
+
+def test_client_metrics():
+    metrics = ClientMetrics()
+    client = httpx.Client(
+        transport=MetricsTransport(metrics, httpx.MockTransport(handle_metrics_request))
+    )
+
+    client.get("http://example.com/")
+    client.get("http://example.com/error")
+    with pytest.raises(httpx.ConnectTimeout):
+        client.get("http://example.com/timeout")
+
+    info = metrics.info()
+    assert info["requests"] == 3
+    assert info["errors"] == 2
+    assert info["in_flight"] == 0
+
+
+def test_async_client_metrics_per_event_loop():
+    metrics = ClientMetrics()
+    transport = AsyncMetricsTransport(
+        metrics, lambda: httpx.MockTransport(handle_metrics_request)
+    )
+    client = httpx.AsyncClient(transport=transport)
+
+    async def get(path: str):
+        try:
+            await client.get(f"http://example.com{path}")
+        except httpx.ConnectTimeout:
+            pass
+        return transport.get_transport()
+
+    # the client is used from two event loops, each gets its own connections
+    first = asyncio.run(get("/"))
+    second = asyncio.run(get("/timeout"))
+
+    assert first is not second
+    assert metrics.info()["requests"] == 2
+    assert metrics.info()["errors"] == 1
+    assert metrics.info()["in_flight"] == 0
+
+
+@patch("core.ai_core.LLM_MODEL_PROVIDER", "openai")
+def test_get_chat_llm_is_shared(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "not-a-key")
+    get_chat_llm.cache_clear()
+
+    llm = get_chat_llm()
+
+    assert get_chat_llm() is llm
+    assert llm.http_client is get_http_clients("llm")[0]
+    assert llm.http_async_client is get_http_clients("llm")[1]
+    assert "llm" in client_metrics
+    get_chat_llm.cache_clear()
+
+
+def test_get_embedding_model_is_shared(fake_embeddings):
+    assert get_embedding_model() is get_embedding_model()
+
+
+def test_citation_matcher():
+    matcher = CitationMatcher(min_overlap=0.6)
+    matcher.add_sources(
+        [
+            Document(
+                page_content="The Cabinet Office supports the Prime Minister. It was founded in 1916.",
+                metadata={"url": "https://example.com/cabinet-office"},
+            ),
+            {"name": "not a source"},
+        ]
+    )
+
+    matcher.feed("thinking...")
+    matcher.start_response()
+    for (
+        token
+    ) in "The Cabinet Office supports the Prime Minister. Nobody knows why".split(" "):
+        matcher.feed(token + " ")
+    # the first sentence is matched before the response has finished
+    assert len(matcher.citations) == 1
+
+    citations = matcher.finish().citations
+    assert citations == [
+        Citation(
+            text_in_answer="The Cabinet Office supports the Prime Minister.",
+            text_in_source="The Cabinet Office supports the Prime Minister.",
+            reference="https://example.com/cabinet-office",
+        )
+    ]
+
+
+def test_citation_matcher_no_sources():
+    matcher = CitationMatcher()
+    matcher.feed("The Cabinet Office supports the Prime Minister.")
+    assert matcher.finish().citations == []
+
+
+def test_citation_matcher_min_overlap(settings):
+    settings.CITATION_MIN_OVERLAP = 0.5
+    assert CitationMatcher().min_overlap == 0.5
+    assert CitationMatcher(min_overlap=0.0).min_overlap == 0.0
+
+
+def test_rate_limiter(settings):
+    settings.EMBEDDING_TOKENS_PER_MINUTE = 60
+    rate_limiter = RateLimiter("EMBEDDING_TOKENS_PER_MINUTE")
+
+    with patch("core.ai_core.time.sleep") as sleep:
+        rate_limiter.acquire(60)
+        sleep.assert_not_called()
+        rate_limiter.acquire(30)
+    assert 29 < sleep.call_args.args[0] <= 30
+
+
+def test_rate_limiter_unlimited(settings):
+    settings.EMBEDDING_TOKENS_PER_MINUTE = 0
+    with patch("core.ai_core.time.sleep") as sleep:
+        RateLimiter("EMBEDDING_TOKENS_PER_MINUTE").acquire(10**6)
+    sleep.assert_not_called()
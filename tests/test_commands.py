@@ -0,0 +1,106 @@
+import math
+from io import StringIO
+from unittest.mock import DEFAULT
+
+import pytest
+from django.core.management import call_command
+
+from core.ingestion import embedding_config
+from core.models import Document, Embedding, ShadowEmbedding
+from .conftest import gaussian
+
+
+@pytest.mark.django_db
+def test_compact_embeddings(user_embedded_document, settings):
+    user_embedded_document.embedding_config = embedding_config()
+    user_embedded_document.save()
+    query = [gaussian(i, 3) for i in range(3072)]
+    expected = [
+        result.metadata["index"]
+        for result in Embedding.search_by_vector(user_embedded_document.user_id, query)
+    ]
+    settings.EMBEDDING_DIMENSIONS = 1024
+    assert embedding_config() != user_embedded_document.embedding_config
+    # the embeddings are longer than the query until they are compacted
+    assert not Embedding.search_by_vector(user_embedded_document.user_id, query[:1024])
+    assert not Embedding.search(user_embedded_document.user_id, "", query[:1024])
+
+    call_command("compact_embeddings", stdout=StringIO())
+
+    user_embedded_document.refresh_from_db()
+    assert user_embedded_document.embedding_config == embedding_config()
+    for embedding in user_embedded_document.embedding_set.all():
+        assert len(embedding.embedding) == 1024
+    query = query[:1024]
+    for search in (
+        Embedding.search_by_vector(user_embedded_document.user_id, query),
+        Embedding.search(user_embedded_document.user_id, "", query),
+    ):
+        assert [result.metadata["index"] for result in search] == expected
+
+    # the shortened embeddings can't be lengthened
+    settings.EMBEDDING_DIMENSIONS = None
+    call_command("compact_embeddings", stdout=StringIO())
+    user_embedded_document.refresh_from_db()
+    assert user_embedded_document.embedding_config != embedding_config()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reembed_documents(user_embedded_document, fake_embeddings):
+    stdout = StringIO()
+    call_command("reembed_documents", "--workers=2", stdout=stdout)
+
+    user_embedded_document.refresh_from_db()
+    assert user_embedded_document.embedding_config == embedding_config()
+    assert user_embedded_document.passage_count == 1
+    assert user_embedded_document.embedding_count == 1
+    assert list(
+        user_embedded_document.embedding_set.values_list("text", flat=True)
+    ) == ["hello!"]
+    assert not ShadowEmbedding.objects.exists()
+    assert "re-embedded 1 of 1 documents" in stdout.getvalue()
+
+    stdout = StringIO()
+    call_command("reembed_documents", stdout=stdout)
+    assert "re-embedded 0 of 0 documents" in stdout.getvalue()
+
+
+@pytest.mark.django_db
+def test_document_reembed_resumes(long_document, embedding_model):
+    long_document.generate_elements()
+    count = long_document.embedding_count
+    embedding_model.embed_documents.reset_mock()
+    embedding_model.embed_documents.side_effect = [DEFAULT, ValueError("rate limited")]
+    with pytest.raises(ValueError):
+        long_document.reembed()
+
+    # the old embeddings are searched until the new ones are all made
+    assert long_document.embedding_set.count() == count
+    assert long_document.shadowembedding_set.count() == 4
+
+    embedding_model.embed_documents.side_effect = None
+    embedding_model.embed_documents.reset_mock()
+    assert long_document.reembed()
+
+    assert long_document.embedding_set.count() == long_document.embedding_count == count
+    assert embedding_model.embed_documents.call_count == math.ceil((count - 4) / 4)
+    indexes = long_document.embedding_set.order_by("index").values_list(
+        "index", flat=True
+    )
+    assert list(indexes) == list(range(count))
+    assert not long_document.shadowembedding_set.exists()
+
+
+@pytest.mark.django_db
+def test_document_reembed_reprocessed(user_embedded_document, embedding_model):
+    def reprocess(texts):
+        Document.objects.filter(pk=user_embedded_document.pk).update(
+            status=Document.STATUSES.PROCESSING
+        )
+        return DEFAULT
+
+    embedding_model.embed_documents.side_effect = reprocess
+    assert not user_embedded_document.reembed()
+
+    assert user_embedded_document.embedding_set.count() == 10
+    assert not user_embedded_document.shadowembedding_set.exists()
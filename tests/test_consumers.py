@@ -1,45 +1,235 @@
-from unittest.mock import patch
+import asyncio
+from unittest.mock import AsyncMock, patch
 
+import orjson
 import pytest
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
 from langchain_core.messages import AIMessage
 
+from core.ai_core import encode_event
 from core.consumers import ChatConsumer
+from core.models import progress_group
 from .conftest import FakeChatModel
 
 
-@pytest.mark.xfail(reason="not working on github")
+async def receive_events(chat, message) -> list[dict]:
+    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"{chat.id}/")
+    communicator.scope["user"] = chat.user
+    communicator.scope["url_route"] = {"kwargs": {"chat_id": chat.id}}
+    connected, _ = await communicator.connect()
+    assert connected
+
+    await communicator.send_json_to(message)
+    events = []
+    while not events or events[-1]["event"] != "done":
+        events.append(orjson.loads(await communicator.receive_from()))
+    await communicator.disconnect()
+    return events
+
+
 @pytest.mark.asyncio
-@pytest.mark.django_db
+@pytest.mark.django_db(transaction=True)
 @patch("core.consumers.get_chat_llm")
 async def test_receive_json(fake_chat_model, async_chat):
-    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"{async_chat.id}/")
-    communicator.scope["user"] = async_chat.user
-    communicator.scope["url_route"] = {"kwargs": {"chat_id": async_chat.id}}
-    connected, _ = await communicator.connect()
+    fake_chat_model.return_value = FakeChatModel(
+        messages=iter(
+            [
+                AIMessage(content="hello there"),
+            ]
+        )
+    )
 
-    assert connected
+    events = await receive_events(async_chat, {"content": "hello"})
 
+    assert events == [
+        {"event": "token", "data": "hello"},
+        {"event": "token", "data": " "},
+        {"event": "token", "data": "there"},
+        {"event": "citations", "data": []},
+        {"event": "done", "data": {"annotated_content": "hello there"}},
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+@patch("core.consumers.get_chat_llm")
+async def test_receive_json_summarises_after_done(fake_chat_model, async_chat):
+    fake_chat_model.return_value = FakeChatModel(
+        messages=iter([AIMessage(content="hello there")])
+    )
+    sent = []
+
+    def send_event(content):
+        sent.append(content["event"])
+        return encode_event(content)
+
+    with (
+        patch("core.consumers.encode_event", side_effect=send_event),
+        patch(
+            "core.consumers.async_task",
+            side_effect=lambda func: sent.append("update_summary"),
+        ),
+    ):
+        await receive_events(async_chat, {"content": "hello"})
+
+    assert sent[-2:] == ["done", "update_summary"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+@patch("core.consumers.get_chat_llm")
+async def test_receive_json_coalesces_tokens(fake_chat_model, async_chat, settings):
+    settings.STREAM_COALESCE_INTERVAL = 60
+    fake_chat_model.return_value = FakeChatModel(
+        messages=iter([AIMessage(content="hello there, how are you?")])
+    )
+
+    events = await receive_events(async_chat, {"content": "hello"})
+
+    assert [event for event in events if event["event"] == "token"] == [
+        {"event": "token", "data": "hello there, how are you?"}
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+@patch("core.consumers.get_chat_llm")
+async def test_receive_json_coalesces_tokens_by_size(
+    fake_chat_model, async_chat, settings
+):
+    settings.STREAM_COALESCE_INTERVAL = 60
+    settings.STREAM_COALESCE_MAX_CHARS = 10
+    fake_chat_model.return_value = FakeChatModel(
+        messages=iter([AIMessage(content="hello there, how are you?")])
+    )
+
+    events = await receive_events(async_chat, {"content": "hello"})
+
+    assert [event["data"] for event in events if event["event"] == "token"] == [
+        "hello there,",
+        " how are you?",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_send_token_flushes_after_interval(settings):
+    settings.STREAM_COALESCE_INTERVAL = 0.01
+    consumer = ChatConsumer()
+    consumer.send_json = AsyncMock()
+
+    await consumer.send_token("hello")
+    await consumer.send_token(" there")
+    consumer.send_json.assert_not_called()
+
+    # the model pauses, the slice is sent anyway
+    await asyncio.sleep(0.05)
+    consumer.send_json.assert_called_once_with(
+        content={"event": "token", "data": "hello there"}
+    )
+
+
+@pytest.mark.asyncio
+async def test_flush_tokens_waits_for_timer(settings):
+    settings.STREAM_COALESCE_INTERVAL = 0.01
+    consumer = ChatConsumer()
+    sent = []
+    # the first send, by the timer, is slower than those after it
+    delays = iter([0.05, 0, 0])
+
+    async def send_json(content):
+        await asyncio.sleep(next(delays))
+        sent.append(content)
+
+    consumer.send_json = send_json
+    await consumer.send_token("hello")
+    # the timer fires and is part way through sending
+    await asyncio.sleep(0.02)
+    await consumer.send_token(" there")
+    await consumer.flush_tokens()
+    await consumer.send_json(content={"event": "done"})
+
+    assert sent == [
+        {"event": "token", "data": "hello"},
+        {"event": "token", "data": " there"},
+        {"event": "done"},
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+@patch("core.consumers.get_chat_llm")
+async def test_receive_json_citations(fake_chat_model, async_chat, wikipedia_server):
     fake_chat_model.return_value = FakeChatModel(
         messages=iter(
             [
-                AIMessage(content="hello"),
-                AIMessage(content="hello"),
+                AIMessage(
+                    content="",
+                    tool_calls=[
+                        {
+                            "name": "search_wikipedia",
+                            "args": {"query": "cabinet office", "top_k_results": 1},
+                            "id": "1",
+                        }
+                    ],
+                ),
+                AIMessage(content="Ask about the Cabinet Office history. Or not!"),
             ]
         )
     )
+    events = await receive_events(async_chat, {"content": "hello"})
+
+    assert [event["event"] for event in events if "token" != event["event"]] == [
+        "tool_start",
+        "tool_end",
+        "citations",
+        "done",
+    ]
+    assert events[0] == {
+        "event": "tool_start",
+        "name": "search_wikipedia",
+        "data": {"query": "cabinet office", "top_k_results": 1},
+    }
+    assert events[1] == {
+        "event": "tool_end",
+        "name": "search_wikipedia",
+        "data": {
+            "sources": [
+                "https://en.wikipedia.org/wiki/Cabinet Office#History",
+                "https://en.wikipedia.org/wiki/Cabinet Office#Functions",
+            ]
+        },
+    }
+    [citations] = [event for event in events if event["event"] == "citations"]
+    assert citations["data"] == [
+        {
+            "index": 1,
+            "text_in_answer": "Ask about the Cabinet Office history.",
+            "text_in_source": "Cabinet Office history",
+            "reference": "https://en.wikipedia.org/wiki/Cabinet Office#History",
+        }
+    ]
+    assert events[-1]["data"]["annotated_content"].startswith(
+        "Ask about the Cabinet Office history.[^1] Or not!"
+    )
 
-    await communicator.send_json_to({"content": "hello"})
-    response_1 = await communicator.receive_json_from()
-    assert response_1["event"] == "on_chain_end"
-    assert len(response_1["data"]["output"]["messages"]) == 3
 
-    response_2 = await communicator.receive_json_from()
-    assert response_2["event"] == "on_chain_end"
-    assert response_2["data"]["output"] == {"citations": []}
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+@patch("core.consumers.get_chat_llm")
+async def test_document_progress(fake_chat_model, async_chat):
+    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"{async_chat.id}/")
+    communicator.scope["user"] = async_chat.user
+    communicator.scope["url_route"] = {"kwargs": {"chat_id": async_chat.id}}
+    await communicator.connect()
 
-    response_3 = await communicator.receive_json_from()
-    assert response_2["event"] == "on_chain_end"
-    assert response_3["data"]["annotated_content"]
+    await get_channel_layer().group_send(
+        progress_group(async_chat.user.id),
+        {"type": "document.progress", "data": {"name": "hello.pdf"}},
+    )
 
+    assert orjson.loads(await communicator.receive_from()) == {
+        "event": "document_progress",
+        "data": {"name": "hello.pdf"},
+    }
     await communicator.disconnect()
@@ -0,0 +1,70 @@
+import hashlib
+import os
+
+from core.ingestion import (
+    convert_pages,
+    spool_file,
+    split_pages,
+    split_sections,
+)
+
+
+def test_split_sections():
+    text = "preamble\n# Title\nintro\n## Sub\nbody\n```\n# not a heading\n```\n# Next\nend\n"
+    assert list(split_sections(text)) == [
+        ([], "preamble\n"),
+        (["Title"], "# Title\nintro\n"),
+        (["Title", "Sub"], "## Sub\nbody\n```\n# not a heading\n```\n"),
+        (["Next"], "# Next\nend\n"),
+    ]
+
+
+def test_split_pages_and_sections(settings):
+    settings.CHUNK_SIZE = 100
+    settings.CHUNK_OVERLAP = 0
+    pages = ["page one", "# Heading\n" + "word " * 50]
+
+    passages = list(split_pages(pages, {"filename": "hello.pdf"}))
+
+    assert passages[0].page_content == "page one"
+    assert passages[0].metadata == {"filename": "hello.pdf", "page_number": 1}
+    assert len(passages) > 2
+    assert all(len(passage.page_content) <= 100 for passage in passages)
+    assert all(
+        passage.metadata
+        == {"filename": "hello.pdf", "page_number": 2, "section": "Heading"}
+        for passage in passages[1:]
+    )
+
+
+def test_split_pages_overlap(settings):
+    settings.CHUNK_SIZE = 20
+    settings.CHUNK_OVERLAP = 10
+    first, second, *_ = split_pages(["one two three four five six seven eight"])
+    assert set(first.page_content.split()) & set(second.page_content.split())
+
+
+def test_split_pages_is_lazy():
+    def pages():
+        yield "page one"
+        raise AssertionError("the second page should not be converted")
+
+    passages = split_pages(pages(), {"filename": "hello.pdf"})
+    assert next(passages).metadata == {"filename": "hello.pdf", "page_number": 1}
+
+
+def test_spool_file_and_convert_pdf_pages(pdf_file):
+    with spool_file(pdf_file) as (path, content_hash):
+        assert path.endswith(".pdf")
+        with open(path, "rb") as local_file:
+            assert content_hash == hashlib.sha256(local_file.read()).hexdigest()
+        pages = convert_pages(path)
+        assert next(pages).strip() == "hello page one"
+        assert next(pages).strip() == "hello page two"
+        assert next(pages, None) is None
+    assert not os.path.exists(path)
+
+
+def test_convert_pages_text(file):
+    with spool_file(file) as (path, _):
+        assert list(convert_pages(path)) == ["hello!"]
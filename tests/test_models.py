@@ -1,12 +1,25 @@
+import asyncio
+import math
+import time
+import uuid
+from unittest.mock import DEFAULT, patch
+
 import pytest
-from langchain_core.messages import AIMessage, HumanMessage
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.utils import timezone
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 
 from core.models import (
+    Chat,
     ChatMessage,
     Citation,
     Embedding,
     Document,
     User,
+    progress_group,
 )
 from .conftest import gaussian
 
@@ -26,6 +39,106 @@ def test_chat_to_langchain(chat):
     ]
 
 
+@pytest.mark.django_db
+def test_chat_to_langchain_token_budget(chat):
+    contents = [
+        "what is the capital of peru",
+        "lima " * 40,
+        "tell me a story",
+        "the cat sat on the mat",
+        "what about the capital of chile",
+    ]
+    for i, content in enumerate(contents):
+        ChatMessage.objects.create(
+            chat=chat,
+            content=content,
+            type=[ChatMessage.TYPES.HUMAN, ChatMessage.TYPES.AI][i % 2],
+        )
+    chat.summary = "the user is asking about south america"
+
+    assert chat.to_langchain(token_budget=30) == [
+        SystemMessage(
+            content="Summary of the conversation so far:\n"
+            "the user is asking about south america"
+        ),
+        HumanMessage(content="what is the capital of peru"),
+        HumanMessage(content="tell me a story"),
+        AIMessage(content="the cat sat on the mat"),
+        HumanMessage(content="what about the capital of chile"),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_chat_ato_langchain(async_chat):
+    for content in ["what is the capital of peru", "lima " * 40, "and chile?"]:
+        await ChatMessage.afrom_langchain(
+            chat=async_chat, message=HumanMessage(content=content)
+        )
+    async_chat.summary = "the user is asking about south america"
+
+    for token_budget in (None, 30):
+        assert await async_chat.ato_langchain(token_budget) == await sync_to_async(
+            async_chat.to_langchain
+        )(token_budget)
+
+    answer = await ChatMessage.afrom_langchain(
+        chat=async_chat, message=AIMessage(content="the cat sat on the mat")
+    )
+    await Citation.objects.acreate(
+        chat_message=answer,
+        text_in_answer="the mat",
+        text_in_source="a mat",
+        reference="https://example.com",
+        index=1,
+    )
+    assert (
+        await answer.aannotated_content()
+        == await sync_to_async(answer.annotated_content)()
+    )
+
+
+@pytest.mark.django_db
+def test_chat_update_summary(chat):
+    for content in ["first question", "first answer", "second question"]:
+        ChatMessage.objects.create(
+            chat=chat, content=content, type=ChatMessage.TYPES.HUMAN
+        )
+
+    with patch("core.models.summarise", return_value="a summary") as summarise:
+        chat.update_summary(token_budget=5)
+        chat.update_summary(token_budget=5)
+
+    summarise.assert_called_once_with(
+        "",
+        [HumanMessage(content="first question"), HumanMessage(content="first answer")],
+    )
+    chat.refresh_from_db()
+    assert chat.summary == "a summary"
+    assert chat.summarised_until == chat.chatmessage_set.all()[1].created_at
+
+
+@pytest.mark.django_db
+def test_chat_update_summary_overlapping(chat):
+    for content in ["first question", "first answer", "second question"]:
+        ChatMessage.objects.create(
+            chat=chat, content=content, type=ChatMessage.TYPES.HUMAN
+        )
+
+    def summarise_meanwhile(summary, messages):
+        # another update is saved while this one waits on the llm
+        Chat.objects.filter(pk=chat.pk).update(
+            summary="their summary", summarised_until=timezone.now()
+        )
+        return "our summary"
+
+    with patch("core.models.summarise", side_effect=summarise_meanwhile):
+        chat.update_summary(token_budget=5)
+
+    chat.refresh_from_db()
+    assert chat.summary == "their summary"
+
+
 @pytest.mark.django_db
 def test_chat_from_langchain(chat):
     initial_count = chat.chatmessage_set.count()
@@ -57,6 +170,34 @@ def test_chat_annotated_content(chat_message):
     )
 
 
+@pytest.mark.django_db
+def test_chat_annotated_content_many_citations(chat_message):
+    citations = Citation.locate(
+        chat_message.content,
+        [
+            Citation(
+                chat_message=chat_message,
+                text_in_answer=text_in_answer,
+                text_in_source="source",
+                reference="www.catfacts.com",
+                index=index,
+            )
+            for index, text_in_answer in enumerate(
+                ["on the mat", "the cat sat", "the cat", "a dog"], start=1
+            )
+        ],
+    )
+    Citation.objects.bulk_create(citations)
+
+    assert [citation.offset for citation in citations] == [22, 11, 7, None]
+    footnotes = "".join(
+        f'\n\n[^{index}]: "source" [source](www.catfacts.com)' for index in (1, 2, 3)
+    )
+    expected = f"the cat[^3] sat[^2] on the mat[^1]{footnotes}"
+    assert chat_message.annotated_content() == expected
+    assert chat_message.annotated_content(citations) == expected
+
+
 @pytest.mark.django_db
 def test_chat_annotated_content_no_citations(chat_message):
     assert chat_message.annotated_content() == "the cat sat on the mat"
@@ -76,11 +217,137 @@ def test_embedding_search_by_vector(user_embedded_document):
     # And the next results to have an index equal to the nearest numbers
     assert actual_embeddings[1].metadata["index"] in (2, 4)
     assert actual_embeddings[2].metadata["index"] in (2, 4)
+    assert not any(embedding.metadata["partial"] for embedding in actual_embeddings)
 
 
 @pytest.mark.django_db
-def test_document_status_processing(user_document):
-    assert user_document.status == "PROCESSING"
+def test_embedding_search_hybrid(user_embedded_document, django_assert_num_queries):
+    Embedding.objects.create(
+        document=user_embedded_document,
+        text="how to fill in a P45",
+        embedding=[gaussian(i, 3000) for i in range(3072)],
+        index=10,
+        metadata={"page_number": 2},
+    )
+    embedding = [gaussian(i, 3) for i in range(3072)]
+
+    # a savepoint, set_config and the search
+    with django_assert_num_queries(4):
+        results = Embedding.search(
+            user_embedded_document.user_id, "P45 form", embedding, top_k_results=3
+        )
+
+    assert {result.metadata["index"] for result in results[:2]} == {3, 10}
+    assert results[2].metadata["index"] in (2, 4)
+    assert not any(result.metadata["partial"] for result in results)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "query", ['"P45 application"', "P45 -missing", "P45's & | ! <-> : \\ form"]
+)
+def test_embedding_search_hybrid_any_word(user_embedded_document, query):
+    Embedding.objects.create(
+        document=user_embedded_document,
+        text="how to fill in a P45",
+        embedding=[gaussian(i, 3000) for i in range(3072)],
+        index=10,
+        metadata={"page_number": 2},
+    )
+    embedding = [gaussian(i, 3) for i in range(3072)]
+
+    results = Embedding.search(user_embedded_document.user_id, query, embedding)
+
+    assert {result.metadata["index"] for result in results[:2]} == {3, 10}
+
+
+@pytest.mark.django_db
+def test_embedding_search_hybrid_no_words(user_embedded_document):
+    embedding = [gaussian(i, 3) for i in range(3072)]
+    results = Embedding.search(user_embedded_document.user_id, "", embedding)
+    assert [result.metadata["index"] for result in results] == [
+        result.metadata["index"]
+        for result in Embedding.search_by_vector(
+            user_embedded_document.user_id, embedding
+        )
+    ]
+
+
+@pytest.mark.django_db
+def test_embedding_search_small_share_of_table(user_embedded_document):
+    """the hnsw index returns about ef_search rows from the whole table before they
+    are filtered by user, for a user with a small share of the table the search
+    falls back to an exact one"""
+    other_user = User.objects.create(email="other@example.com")
+    other_document = Document.objects.create(
+        user=other_user, file=SimpleUploadedFile(name="other.txt", content=b"hi")
+    )
+    embedding = [gaussian(i, 3) for i in range(3072)]
+    Embedding.objects.bulk_create(
+        Embedding(
+            document=other_document,
+            text="other",
+            embedding=embedding,
+            index=index,
+            metadata={},
+        )
+        for index in range(400)
+    )
+    with connection.cursor() as cursor:
+        # as the planner would with a large table
+        cursor.execute("ANALYZE core_embedding")
+        cursor.execute("SET enable_seqscan = off")
+        cursor.execute("SET enable_bitmapscan = off")
+        cursor.execute("SET enable_sort = off")
+
+    for results in (
+        Embedding.search_by_vector(user_embedded_document.user_id, embedding),
+        Embedding.search(user_embedded_document.user_id, "", embedding),
+    ):
+        assert [result.metadata["index"] for result in results][:1] == [3]
+        assert len(results) == 3
+
+
+@pytest.mark.asyncio
+async def test_embedding_asearch_concurrent():
+    def search(*args):
+        time.sleep(0.2)
+        return []
+
+    started_at = time.monotonic()
+    with patch.object(Embedding, "search", side_effect=search):
+        await asyncio.gather(
+            *(Embedding.asearch(uuid.uuid4(), "hello", [1.0] * 3072) for _ in range(3))
+        )
+
+    # searches run at once, in the time of one
+    assert time.monotonic() - started_at < 0.4
+
+
+@pytest.mark.django_db
+def test_embedding_search_by_vector_while_processing(
+    long_document, embedding_model, settings
+):
+    settings.EMBEDDING_BATCH_SIZE = 2
+    user_id = long_document.user_id
+    found = []
+
+    def embed_documents(texts):
+        found.append(Embedding.search_by_vector(user_id, [1.0] * 3072, 10))
+        return DEFAULT
+
+    embedding_model.embed_documents.side_effect = embed_documents
+    long_document.generate_elements()
+
+    assert [len(results) for results in found[:3]] == [0, 2, 4]
+    assert all(result.metadata["partial"] for result in found[1])
+    final = Embedding.search_by_vector(user_id, [1.0] * 3072, 10)
+    assert not any(result.metadata["partial"] for result in final)
+
+
+@pytest.mark.django_db
+def test_document_status_queued(user_document):
+    assert user_document.status == "QUEUED"
 
 
 @pytest.mark.django_db
@@ -89,10 +356,14 @@ def test_document_status_complete(user_embedded_document):
 
 
 @pytest.mark.django_db
-def test_document_status_error(user_document):
-    user_document.processing_error = "some error"
-    user_document.save()
+def test_document_status_error(user_document, fake_embeddings):
+    with patch("core.ingestion.md.convert_local", side_effect=ValueError("some error")):
+        user_document.generate_elements()
+
+    user_document.refresh_from_db()
     assert user_document.status == "ERROR"
+    assert user_document.processing_error == "some error"
+    assert user_document.processing_finished_at >= user_document.processing_started_at
 
 
 @pytest.mark.django_db
@@ -102,14 +373,119 @@ def test_document_delete_by_name(user_document):
 
 @pytest.mark.django_db
 def test_document_generate_elements(user_document, fake_embeddings):
-    assert user_document.status == "PROCESSING"
+    assert user_document.status == "QUEUED"
     assert user_document.processing_error is None
     assert user_document.embedding_set.count() == 0
     user_document.generate_elements()
 
+    user_document.refresh_from_db()
     assert user_document.status == "COMPLETE"
     assert user_document.processing_error is None
     assert user_document.embedding_set.count() == 1
+    assert user_document.passage_count == user_document.embedding_count == 1
+    assert user_document.processing_finished_at >= user_document.processing_started_at
+
+
+@pytest.mark.django_db
+def test_document_generate_elements_pdf(user, pdf_file, fake_embeddings):
+    document = Document.objects.create(user=user, file=pdf_file)
+    document.generate_elements()
+
+    assert document.status == "COMPLETE"
+    assert [
+        (embedding.text, embedding.metadata["page_number"])
+        for embedding in document.embedding_set.order_by("index")
+    ] == [("hello page one", 1), ("hello page two", 2)]
+    document.delete()
+
+
+@pytest.mark.django_db
+def test_document_generate_elements_publishes_progress(
+    user, pdf_file, fake_embeddings, settings
+):
+    settings.EMBEDDING_BATCH_SIZE = 1
+    channel_layer = get_channel_layer()
+    channel = async_to_sync(channel_layer.new_channel)()
+    async_to_sync(channel_layer.group_add)(progress_group(user.id), channel)
+    document = Document.objects.create(user=user, file=pdf_file)
+
+    document.generate_elements()
+
+    progress = [async_to_sync(channel_layer.receive)(channel)["data"] for _ in range(4)]
+    assert [
+        (update["status"], update["page_number"], update["embedding_count"])
+        for update in progress
+    ] == [
+        ("PROCESSING", None, 0),
+        ("PROCESSING", 1, 1),
+        ("PROCESSING", 2, 2),
+        ("COMPLETE", None, 2),
+    ]
+    assert progress[1]["page_count"] == 2
+    assert progress[1]["eta_seconds"] is not None
+    document.delete()
+
+
+@pytest.mark.django_db
+def test_document_generate_elements_batched(long_document, embedding_model):
+    long_document.generate_elements()
+
+    assert long_document.processing_error is None
+    count = long_document.embedding_set.count()
+    assert count > 4
+    assert embedding_model.embed_documents.call_count == math.ceil(count / 4)
+    assert all(
+        len(call.args[0]) <= 4 for call in embedding_model.embed_documents.mock_calls
+    )
+    indexes = long_document.embedding_set.order_by("index").values_list(
+        "index", flat=True
+    )
+    assert list(indexes) == list(range(count))
+
+
+@pytest.mark.django_db
+def test_document_generate_elements_resumes(long_document, embedding_model):
+    embedding_model.embed_documents.side_effect = [DEFAULT, ValueError("rate limited")]
+    long_document.generate_elements()
+
+    assert long_document.status == "ERROR"
+    assert long_document.embedding_count == long_document.embedding_set.count() == 4
+
+    embedding_model.embed_documents.side_effect = None
+    embedding_model.embed_documents.reset_mock()
+    long_document.generate_elements()
+
+    assert long_document.status == "COMPLETE"
+    count = long_document.embedding_set.count()
+    assert long_document.passage_count == long_document.embedding_count == count
+    assert embedding_model.embed_documents.call_count == math.ceil((count - 4) / 4)
+    indexes = long_document.embedding_set.order_by("index").values_list(
+        "index", flat=True
+    )
+    assert list(indexes) == list(range(count))
+
+
+@pytest.mark.django_db
+def test_document_generate_elements_reuses_identical_file(
+    user_document, embedding_model
+):
+    copy = Document.objects.create(
+        user=user_document.user,
+        file=SimpleUploadedFile(name="copy.txt", content=b"hello!"),
+    )
+
+    user_document.generate_elements()
+    copy.generate_elements()
+
+    assert embedding_model.embed_documents.call_count == 1
+    assert copy.content_hash == user_document.content_hash
+    assert copy.status == "COMPLETE"
+    original_embedding = user_document.embedding_set.get()
+    copied_embedding = copy.embedding_set.get()
+    assert copied_embedding.text == original_embedding.text
+    assert list(copied_embedding.embedding) == list(original_embedding.embedding)
+    assert copied_embedding.metadata["filename"] == copy.file.name
+    copy.delete()
 
 
 @pytest.mark.django_db
@@ -122,6 +498,25 @@ def test_model_get_history(user_with_many_chat_messages):
     assert all(chat.chatmessage_set.count() > 1 for chat in chats)
 
 
+@pytest.mark.django_db
+def test_model_get_history_pages(user_with_many_chat_messages):
+    first_page = list(user_with_many_chat_messages.get_history(limit=5))
+    last_chat = first_page[-1]
+    second_page = list(
+        user_with_many_chat_messages.get_history(
+            limit=5, before=(last_chat.last_message_at, last_chat.pk)
+        )
+    )
+
+    assert len(second_page) == 4
+    assert not {chat.pk for chat in first_page} & {chat.pk for chat in second_page}
+    chats = first_page + second_page
+    assert [chat.last_message_at for chat in chats] == sorted(
+        (chat.last_message_at for chat in chats), reverse=True
+    )
+    assert all(chat.message_count == chat.chatmessage_set.count() > 0 for chat in chats)
+
+
 @pytest.mark.django_db
 def test_create_superuser():
     user = User.objects.create_superuser("me@example.com", "password")
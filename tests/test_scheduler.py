@@ -0,0 +1,159 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
+from django_q.models import Schedule
+
+from core.models import Document, User
+from core.scheduler import (
+    claim_next_document,
+    ingest_next_document,
+    schedule_sweep,
+    sweep_documents,
+)
+
+
+@pytest.fixture
+def other_user():
+    user = User.objects.create(email="other@example.com")
+    yield user
+    user.delete()
+
+
+def create_document(user, name: str, **kwargs) -> Document:
+    return Document.objects.create(
+        user=user, file=SimpleUploadedFile(name=name, content=b"hello!"), **kwargs
+    )
+
+
+@pytest.mark.django_db
+def test_claim_next_document_is_fair(user, other_user):
+    busy = create_document(user, "busy.txt", status=Document.STATUSES.PROCESSING)
+    busy.processing_started_at = timezone.now()
+    busy.save()
+    first = create_document(user, "first.txt")
+    second = create_document(other_user, "second.txt")
+
+    assert claim_next_document("small") == second
+    assert claim_next_document("small") == first
+    assert claim_next_document("small") is None
+
+    first.refresh_from_db()
+    assert first.status == Document.STATUSES.PROCESSING
+    assert first.attempts == 1
+    for document in (busy, first, second):
+        document.delete()
+
+
+@pytest.mark.django_db
+def test_claim_next_document_by_size(user, settings):
+    settings.INGESTION_LARGE_FILE_SIZE = 100
+    small = create_document(user, "small.txt", size=10)
+    large = create_document(user, "large.txt", size=1000)
+
+    assert claim_next_document("large") == large
+    assert claim_next_document("large") is None
+    assert claim_next_document("small") == small
+    small.delete()
+    large.delete()
+
+
+@pytest.mark.django_db
+def test_claim_next_document_waits_for_retry(user):
+    document = create_document(user, "retry.txt")
+    document.retry_at = timezone.now() + timedelta(minutes=1)
+    document.save()
+
+    assert claim_next_document("small") is None
+    document.retry_at = timezone.now()
+    document.save()
+    assert claim_next_document("small") == document
+    document.delete()
+
+
+@pytest.mark.django_db
+def test_sweep_documents(user, settings):
+    settings.INGESTION_MAX_ATTEMPTS = 2
+    an_hour_ago = timezone.now() - timedelta(hours=1)
+    stuck = create_document(
+        user, "stuck.txt", status=Document.STATUSES.PROCESSING, attempts=1
+    )
+    last_attempt = create_document(
+        user, "last.txt", status=Document.STATUSES.PROCESSING, attempts=2
+    )
+    Document.objects.filter(pk__in=[stuck.pk, last_attempt.pk]).update(
+        processing_started_at=an_hour_ago
+    )
+    # documents migrated as processing have no start time
+    unstarted = create_document(
+        user, "unstarted.txt", status=Document.STATUSES.PROCESSING
+    )
+    due = create_document(user, "due.txt", retry_at=an_hour_ago)
+    waiting = create_document(
+        user, "waiting.txt", retry_at=timezone.now() + timedelta(hours=1)
+    )
+    busy = create_document(user, "busy.txt", status=Document.STATUSES.PROCESSING)
+    busy.processing_started_at = timezone.now()
+    busy.save()
+
+    with patch("core.scheduler.async_task") as async_task:
+        sweep_documents()
+
+    assert async_task.call_count == 3
+    async_task.assert_called_with(ingest_next_document, "small", cluster=None)
+    for document, status in [
+        (stuck, Document.STATUSES.QUEUED),
+        (last_attempt, Document.STATUSES.ERROR),
+        (unstarted, Document.STATUSES.QUEUED),
+        (due, Document.STATUSES.QUEUED),
+        (waiting, Document.STATUSES.QUEUED),
+        (busy, Document.STATUSES.PROCESSING),
+    ]:
+        document.refresh_from_db()
+        assert document.status == status
+    assert due.retry_at is None
+    assert waiting.retry_at is not None
+    for document in (stuck, last_attempt, unstarted, due, waiting, busy):
+        document.delete()
+
+
+@pytest.mark.django_db
+def test_schedule_sweep(settings):
+    # created when the test database was migrated
+    schedule = Schedule.objects.get(name="sweep_documents")
+    assert schedule.func == "core.scheduler.sweep_documents"
+
+    settings.INGESTION_SWEEP_MINUTES = 5
+    schedule_sweep()
+
+    schedule.refresh_from_db()
+    assert schedule.minutes == 5
+    assert Schedule.objects.filter(name="sweep_documents").count() == 1
+
+
+@pytest.mark.django_db
+def test_ingest_next_document_retries(user_document, fake_embeddings, settings):
+    settings.INGESTION_MAX_ATTEMPTS = 2
+    settings.INGESTION_RETRY_DELAY = 60
+
+    with patch("core.models.convert_pages", side_effect=ValueError("flaky")):
+        ingest_next_document("small")
+
+    user_document.refresh_from_db()
+    assert user_document.status == Document.STATUSES.QUEUED
+    assert user_document.retry_at > timezone.now() + timedelta(seconds=50)
+
+    # it isn't retried until its delay is over
+    ingest_next_document("small")
+    user_document.refresh_from_db()
+    assert user_document.attempts == 1
+
+    user_document.retry_at = timezone.now()
+    user_document.save()
+    ingest_next_document("small")
+
+    user_document.refresh_from_db()
+    assert user_document.status == Document.STATUSES.COMPLETE
+    assert user_document.attempts == 2
@@ -1,10 +1,23 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from uuid import uuid4
+
 import pytest
+import requests
+import wikipedia
+from asgiref.sync import sync_to_async
 
+from core.models import Embedding
 from core.tools import (
+    WikipediaRequests,
     list_documents,
     list_chats,
     build_delete_document,
+    fetch_wikipedia_page,
     search_documents,
+    search_wikipedia,
 )
 
 
@@ -14,6 +27,21 @@ def test_list_documents(user_with_many_documents):
     assert len(documents) > 0
 
 
+@pytest.mark.django_db
+def test_list_documents_status(user_with_many_documents, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        message = list_documents.invoke(
+            {
+                "type": "tool_call",
+                "name": "list_documents",
+                "id": "1",
+                "args": {"user_id": user_with_many_documents.id},
+            }
+        )
+    assert len(message.artifact) == 10
+    assert {document["status"] for document in message.artifact} == {"QUEUED"}
+
+
 @pytest.mark.django_db
 def test_list_chats(user_with_many_chat_messages):
     chats = list_chats.invoke({"user_id": user_with_many_chat_messages.id})
@@ -22,8 +50,25 @@ def test_list_chats(user_with_many_chat_messages):
 
 @pytest.mark.django_db
 def test_build_delete_document(user_document):
-    delete_document = build_delete_document(user_document.user.id)
-    assert delete_document.invoke({"exact_document_name": user_document.file.name})
+    delete_document = build_delete_document((user_document.file.name,))
+    assert delete_document.invoke(
+        {
+            "user_id": user_document.user.id,
+            "exact_document_name": user_document.file.name,
+        }
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_build_delete_document_async(user_document):
+    delete_document = build_delete_document((user_document.file.name,))
+    tool_input = {
+        "user_id": user_document.user_id,
+        "exact_document_name": user_document.file.name,
+    }
+    assert await delete_document.ainvoke(tool_input)
+    assert not await delete_document.ainvoke(tool_input)
 
 
 @pytest.mark.django_db
@@ -32,3 +77,155 @@ def test_search_documents(user_embedded_document, fake_embeddings):
     assert search_documents.invoke(
         {"user_id": user_embedded_document.user.id, "query": "hello"}
     )
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_search_documents_async(user_embedded_document, fake_embeddings):
+    tool_input = {"user_id": user_embedded_document.user_id, "query": "example"}
+    assert await search_documents.ainvoke(tool_input) == await sync_to_async(
+        search_documents.invoke
+    )(tool_input)
+
+    assert await list_documents.ainvoke(
+        {"user_id": user_embedded_document.user_id}
+    ) == await sync_to_async(list_documents.invoke)(
+        {"user_id": user_embedded_document.user_id}
+    )
+
+
+@pytest.mark.asyncio
+async def test_search_documents_async_concurrent(embedding_model):
+    def search(*args):
+        time.sleep(0.2)
+        return []
+
+    # tools called at once run concurrently, in the time of the slowest
+    started_at = time.monotonic()
+    with patch.object(Embedding, "search", side_effect=search):
+        await asyncio.gather(
+            *(
+                search_documents.ainvoke({"user_id": uuid4(), "query": f"query {i}"})
+                for i in range(3)
+            )
+        )
+
+    assert time.monotonic() - started_at < 0.4
+    assert embedding_model.aembed_query.call_count == 3
+
+
+def test_search_wikipedia(wikipedia_server, settings):
+    settings.WIKIPEDIA_TIMEOUT = 0.5
+
+    started_at = time.monotonic()
+    message = search_wikipedia.invoke(
+        {
+            "type": "tool_call",
+            "id": "1",
+            "name": "search_wikipedia",
+            "args": {"query": "cabinet office"},
+        }
+    )
+
+    assert time.monotonic() - started_at < 1
+    assert message.content == "Cabinet Office history\n\nCabinet Office functions"
+    assert [source.metadata["url"] for source in message.artifact] == [
+        "https://en.wikipedia.org/wiki/Cabinet Office#History",
+        "https://en.wikipedia.org/wiki/Cabinet Office#Functions",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_search_wikipedia_async(wikipedia_server, settings):
+    settings.WIKIPEDIA_TIMEOUT = 0.5
+
+    # tools called at once run concurrently, in the time of the slowest
+    started_at = time.monotonic()
+    messages = await asyncio.gather(
+        *(
+            search_wikipedia.ainvoke(
+                {
+                    "type": "tool_call",
+                    "id": str(i),
+                    "name": "search_wikipedia",
+                    "args": {"query": f"cabinet office {i}"},
+                }
+            )
+            for i in range(3)
+        )
+    )
+
+    assert time.monotonic() - started_at < 1
+    for message in messages:
+        assert message.content == "Cabinet Office history\n\nCabinet Office functions"
+        assert [source.metadata["url"] for source in message.artifact] == [
+            "https://en.wikipedia.org/wiki/Cabinet Office#History",
+            "https://en.wikipedia.org/wiki/Cabinet Office#Functions",
+        ]
+
+
+def test_fetch_wikipedia_page_timeout(wikipedia_server, settings):
+    settings.WIKIPEDIA_TIMEOUT = 0.2
+    with pytest.raises(requests.Timeout):
+        fetch_wikipedia_page("Slow")
+
+
+def test_wikipedia_requests_session_per_thread(wikipedia_server):
+    wikipedia_requests = WikipediaRequests()
+
+    def get_session():
+        params = {"list": "search", "srsearch": "cabinet office", "srlimit": 1}
+        wikipedia_requests.get(wikipedia.wikipedia.API_URL, params=params)
+        return wikipedia_requests.local.session
+
+    session = get_session()
+    assert get_session() is session
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(get_session).result() is not session
+
+
+def test_search_wikipedia_unavailable():
+    with patch("wikipedia.wikipedia.API_URL", "http://localhost:1/"):
+        message = search_wikipedia.invoke(
+            {
+                "type": "tool_call",
+                "id": "1",
+                "name": "search_wikipedia",
+                "args": {"query": "cabinet office unavailable"},
+            }
+        )
+    assert message.content == "No good Wikipedia Search Result was found"
+
+
+def test_search_wikipedia_doc_content_chars_max(wikipedia_server):
+    started_at = time.monotonic()
+    message = search_wikipedia.invoke(
+        {
+            "type": "tool_call",
+            "id": "1",
+            "name": "search_wikipedia",
+            "args": {"query": "cabinet office", "doc_content_chars_max": 10},
+        }
+    )
+
+    # the slow page isn't waited for as the first page has enough content
+    assert time.monotonic() - started_at < 1
+    assert message.content == "Cabinet Of"
+    assert len(message.artifact) == 1
+
+
+def test_search_wikipedia_cached(wikipedia_server):
+    tool_call = {
+        "type": "tool_call",
+        "id": "1",
+        "name": "search_wikipedia",
+        "args": {"query": "cabinet office", "top_k_results": 1},
+    }
+    first_message = search_wikipedia.invoke(tool_call)
+    request_count = wikipedia_server.request_count
+
+    second_message = search_wikipedia.invoke(tool_call)
+
+    assert wikipedia_server.request_count == request_count
+    assert second_message.content == first_message.content
+    assert second_message.artifact == first_message.artifact
@@ -44,6 +44,19 @@ def test_chat_detail(client, user, chat):
     assert response.status_code == 200
 
 
+@pytest.mark.django_db
+def test_chat_detail_older_chats(client, user_with_many_chat_messages):
+    client.force_login(user_with_many_chat_messages)
+    chats = list(user_with_many_chat_messages.get_history(limit=10))
+    url = reverse("chat-detail", args=(chats[0].pk,))
+
+    response = client.get(url, {"before": chats[3].pk})
+
+    assert response.status_code == 200
+    assert response.context["chat_history"] == chats[4:]
+    assert response.context["older_chats"] is None
+
+
 @pytest.mark.django_db
 def test_chat_detail_add_file(client, user, chat, file, requests_mock, fake_embeddings):
     initial_doc_count = Document.objects.count()